@@ -0,0 +1,569 @@
+#!/usr/bin/python -t
+"""
+DES-CHAN: A Framework for Channel Assignment Algorithms for Testbeds
+
+This module provides building blocks for centralized channel assignment
+algorithms on a ConflictGraph. The interference model of the conflict graph
+has to provide get_node_conflicts(graph) and get_channel_interference(channel1,
+channel2), so the interference of a link can be computed from the channels of
+the links it is in conflict with, without evaluating the model for every pair
+of links. The node conflicts may be directional, i.e., map each node to the
+nodes it senses, see ConflictGraph.get_ordered_vertices().
+
+Authors:    Matthias Philipp <mphilipp@inf.fu-berlin.de>,
+            Felix Juraschek <fjuraschek@gmail.com>
+
+Copyright 2008-2013, Freie Universitaet Berlin (FUB). All rights reserved.
+
+These sources were developed at the Freie Universitaet Berlin,
+Computer Systems and Telematics / Distributed, embedded Systems (DES) group
+(http://cst.mi.fu-berlin.de, http://www.des-testbed.net)
+-------------------------------------------------------------------------------
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see http://www.gnu.org/licenses/ .
+--------------------------------------------------------------------------------
+For further information and questions please use the web site
+       http://www.des-testbed.net
+
+"""
+
+import heapq
+import math
+import multiprocessing
+import random
+import time
+
+from des_chan.error import CHANError
+
+# interference changes below this value are ignored
+EPSILON = 1e-9
+# default time budget (in seconds) of the optimizers
+TIME_BUDGET = 10.0
+# number of iterations after which a move is no longer tabu
+TABU_TENURE = 10
+# number of vertices whose moves are evaluated per tabu search iteration
+TABU_SAMPLE_SIZE = 20
+# start and end temperature of simulated annealing
+SA_START_TEMPERATURE = 1.0
+SA_END_TEMPERATURE = 0.01
+# number of iterations between two checks of the time budget
+CHECK_INTERVAL = 100
+
+
+class AssignmentState:
+    """Channel assignment of the vertices of a ConflictGraph. For each vertex,
+    the number of conflicting vertices per channel is maintained, so the
+    interference of a vertex on any channel, and the change of the overall
+    interference if its channel is changed, are computed in O(number of
+    channels). The conflict graph and its network graph are only modified by
+    apply().
+
+    If radios is given, a node must not use more than radios distinct channels
+    for its links.
+
+    """
+
+    def __init__(self, conflict_graph, channels, radios=None):
+        model = conflict_graph.interference_model
+        if not hasattr(model, "get_node_conflicts") or \
+           not hasattr(model, "get_channel_interference"):
+            raise CHANError("Unable to assign channels (interference model %s does not provide node conflicts)" % model.__name__)
+        self.conflict_graph = conflict_graph
+        self.channels = list(channels)
+        self.radios = radios
+        self.vertices = list(conflict_graph.get_vertices())
+        # vertex -> list of vertices it is in conflict with
+        self.neighbors = get_conflict_neighbors(conflict_graph)
+        # vertex -> channel
+        self.channel = dict()
+        for vertex in self.vertices:
+            try:
+                self.channel[vertex] = vertex.get_channel()
+            except (TypeError, ValueError):
+                raise CHANError("Unable to assign channels (invalid channel for edge %s)" % (vertex.nw_graph_edge,))
+        # channels applied to the conflict graph
+        self.applied = dict(self.channel)
+        # channel -> channel -> interference value
+        self.interference = dict()
+        all_channels = set(self.channels) | set(self.channel.values())
+        for channel1 in all_channels:
+            self.interference[channel1] = dict()
+            for channel2 in all_channels:
+                self.interference[channel1][channel2] = model.get_channel_interference(channel1, channel2)
+        # vertex -> channel -> number of conflicting vertices on the channel
+        self.counts = dict()
+        for vertex in self.vertices:
+            counts = dict()
+            for neighbor in self.neighbors[vertex]:
+                channel = self.channel[neighbor]
+                counts[channel] = counts.get(channel, 0) + 1
+            self.counts[vertex] = counts
+        # node -> channel -> number of links of the node on the channel
+        self.node_channels = dict()
+        for vertex in self.vertices:
+            for node in vertex.nw_graph_edge:
+                node_channels = self.node_channels.setdefault(node, dict())
+                channel = self.channel[vertex]
+                node_channels[channel] = node_channels.get(channel, 0) + 1
+
+
+    def get_cost(self, vertex, channel):
+        """Returns the interference of the vertex if it used the given channel.
+
+        """
+        interference = self.interference[channel]
+        cost = 0
+        for other_channel, count in self.counts[vertex].iteritems():
+            cost += count * interference[other_channel]
+        return cost
+
+
+    def get_interference(self, vertex):
+        """Returns the current interference of the vertex.
+
+        """
+        return self.get_cost(vertex, self.channel[vertex])
+
+
+    def get_total_interference(self):
+        """Returns the overall interference, which equals the interference sum
+        of the conflict graph after apply().
+
+        """
+        total = 0
+        for vertex in self.vertices:
+            total += self.get_interference(vertex)
+        # each conflict is counted by both vertices
+        return total / 2
+
+
+    def get_delta(self, vertex, channel):
+        """Returns the change of the overall interference if the vertex used the
+        given channel.
+
+        """
+        return self.get_cost(vertex, channel) - self.get_interference(vertex)
+
+
+    def is_allowed(self, vertex, channel):
+        """Returns if the vertex may use the given channel without exceeding the
+        number of radios of its end nodes.
+
+        """
+        if self.radios is None:
+            return True
+        current = self.channel[vertex]
+        for node in vertex.nw_graph_edge:
+            node_channels = self.node_channels[node]
+            if channel in node_channels:
+                continue
+            num_channels = len(node_channels)
+            if node_channels[current] == 1:
+                # the current channel is released by the move
+                num_channels -= 1
+            if num_channels >= self.radios:
+                return False
+        return True
+
+
+    def get_best_channel(self, vertex):
+        """Returns the allowed channel with the lowest interference for the
+        vertex and the change of the overall interference. The current channel
+        is returned, if no other channel is better.
+
+        """
+        current = self.channel[vertex]
+        best_channel = current
+        best_cost = self.get_cost(vertex, current)
+        current_cost = best_cost
+        for channel in self.channels:
+            if channel == current:
+                continue
+            cost = self.get_cost(vertex, channel)
+            if cost < best_cost - EPSILON and self.is_allowed(vertex, channel):
+                best_channel = channel
+                best_cost = cost
+        return best_channel, best_cost - current_cost
+
+
+    def get_random_vertex(self, rand, max_tries=10):
+        """Returns a random vertex, preferring vertices with interference.
+
+        """
+        for i in range(max_tries):
+            vertex = rand.choice(self.vertices)
+            if self.get_interference(vertex) > EPSILON:
+                return vertex
+        return vertex
+
+
+    def move(self, vertex, channel):
+        """Assigns the channel to the vertex and updates the counts of the
+        conflicting vertices.
+
+        """
+        old_channel = self.channel[vertex]
+        if channel == old_channel:
+            return
+        for neighbor in self.neighbors[vertex]:
+            counts = self.counts[neighbor]
+            if counts[old_channel] == 1:
+                del counts[old_channel]
+            else:
+                counts[old_channel] -= 1
+            counts[channel] = counts.get(channel, 0) + 1
+        for node in vertex.nw_graph_edge:
+            node_channels = self.node_channels[node]
+            if node_channels[old_channel] == 1:
+                del node_channels[old_channel]
+            else:
+                node_channels[old_channel] -= 1
+            node_channels[channel] = node_channels.get(channel, 0) + 1
+        self.channel[vertex] = channel
+
+
+    def apply(self):
+        """Sets the channels in the network graph and re-evaluates the conflict
+        graph edges of the changed vertices with the interference model.
+        Returns the list of vertices whose channel has changed.
+
+        """
+        network_graph = self.conflict_graph.network_graph
+        changed = [vertex for vertex in self.vertices
+                   if self.channel[vertex] != self.applied[vertex]]
+        for vertex in changed:
+            # the edge still exists, so the distances do not change
+            network_graph.set_edge_value(vertex.nw_graph_edge,
+                                         str(self.channel[vertex]), False)
+        for vertex in changed:
+            self.conflict_graph.update_edge(vertex)
+            self.applied[vertex] = self.channel[vertex]
+        return changed
+
+
+def get_conflict_neighbors(conflict_graph):
+    """Returns a dictionary that maps each vertex of the conflict graph to the
+    list of vertices it is in conflict with, i.e., whose links interfere with
+    its link if they use interfering channels. If the node conflicts are
+    directional, a pair of vertices is in conflict if the vertex that comes
+    first in ConflictGraph.get_ordered_vertices() senses the other one, since
+    the conflict graph evaluates the pair in this direction.
+
+    """
+    model = conflict_graph.interference_model
+    node_conflicts = model.get_node_conflicts(conflict_graph.network_graph)
+    vertices = conflict_graph.get_ordered_vertices()
+    # node -> vertices of the links of the node
+    node_vertices = dict()
+    for vertex in vertices:
+        for node in vertex.nw_graph_edge:
+            node_vertices.setdefault(node, list()).append(vertex)
+    position = dict([(vertex, i) for i, vertex in enumerate(vertices)])
+    neighbors = dict([(vertex, list()) for vertex in vertices])
+    for vertex in vertices:
+        nodes = set()
+        for node in vertex.nw_graph_edge:
+            nodes |= node_conflicts.get(node, set([node]))
+        conflicting = set()
+        for node in nodes:
+            conflicting.update(node_vertices.get(node, ()))
+        for other in conflicting:
+            if position[other] > position[vertex]:
+                neighbors[vertex].append(other)
+                neighbors[other].append(vertex)
+    return neighbors
+
+
+def greedy_assignment(conflict_graph, channels, radios=None):
+    """Assigns channels to the vertices of the conflict graph. The vertex with
+    the highest interference is repeatedly moved to the allowed channel that
+    lowers its interference the most, until no vertex can be improved. Only
+    the conflicting vertices of a moved vertex are re-evaluated. The channels
+    are set in the network graph and the conflict graph. Returns the list of
+    vertices whose channel has changed.
+
+    """
+    state = AssignmentState(conflict_graph, channels, radios)
+    improve(state)
+    return state.apply()
+
+
+def improve(state):
+    """Runs the greedy improvement of greedy_assignment(..) on the given
+    AssignmentState without applying it. Returns the number of moves.
+
+    """
+    # vertex -> version of its current heap entry, outdated entries are skipped
+    versions = dict([(vertex, 0) for vertex in state.vertices])
+    heap = list()
+    counter = 0
+    for vertex in state.vertices:
+        interference = state.get_interference(vertex)
+        if interference > EPSILON:
+            heap.append((-interference, counter, 0, vertex))
+            counter += 1
+    heapq.heapify(heap)
+    moves = 0
+    while heap:
+        key, count, version, vertex = heapq.heappop(heap)
+        if version != versions[vertex]:
+            continue
+        channel, delta = state.get_best_channel(vertex)
+        if delta > -EPSILON:
+            continue
+        state.move(vertex, channel)
+        moves += 1
+        # the interference of the moved vertex and its conflicting vertices has
+        # changed
+        for changed in [vertex] + state.neighbors[vertex]:
+            versions[changed] += 1
+            interference = state.get_interference(changed)
+            if interference > EPSILON:
+                heapq.heappush(heap, (-interference, counter, versions[changed], changed))
+                counter += 1
+    return moves
+
+
+def tabu_search(state, time_budget=TIME_BUDGET, tenure=TABU_TENURE,
+                sample_size=TABU_SAMPLE_SIZE, seed=None):
+    """Improves the channels of the given AssignmentState by tabu search until
+    the time budget (in seconds) is used up. In each iteration, the best move of
+    a sample of vertices is made, even if it increases the interference.
+    Moving a vertex back to a channel it left is tabu for tenure iterations,
+    unless it leads to a new best assignment. The state is left at the best
+    assignment found. Returns its overall interference.
+
+    """
+    rand = random.Random(seed)
+    total = state.get_total_interference()
+    best_total = total
+    # moves since the best assignment, undone at the end
+    undo = list()
+    # (vertex, channel) -> first iteration in which the move is allowed again
+    tabu = dict()
+    end_time = time.time() + time_budget
+    iteration = 0
+    while best_total > EPSILON:
+        iteration += 1
+        if iteration % CHECK_INTERVAL == 0 and time.time() > end_time:
+            break
+        best_move = None
+        best_delta = None
+        for i in range(sample_size):
+            vertex = state.get_random_vertex(rand)
+            current_cost = state.get_interference(vertex)
+            for channel in state.channels:
+                if channel == state.channel[vertex]:
+                    continue
+                delta = state.get_cost(vertex, channel) - current_cost
+                if best_delta is not None and delta >= best_delta:
+                    continue
+                if tabu.get((vertex, channel), 0) > iteration and \
+                   total + delta >= best_total - EPSILON:
+                    continue
+                if not state.is_allowed(vertex, channel):
+                    continue
+                best_move = (vertex, channel)
+                best_delta = delta
+        if best_move is None:
+            continue
+        vertex, channel = best_move
+        old_channel = state.channel[vertex]
+        tabu[(vertex, old_channel)] = iteration + tenure
+        state.move(vertex, channel)
+        undo.append((vertex, old_channel))
+        total += best_delta
+        if total < best_total - EPSILON:
+            best_total = total
+            undo = list()
+    for vertex, channel in reversed(undo):
+        state.move(vertex, channel)
+    return best_total
+
+
+def simulated_annealing(state, time_budget=TIME_BUDGET,
+                        start_temperature=SA_START_TEMPERATURE,
+                        end_temperature=SA_END_TEMPERATURE, seed=None):
+    """Improves the channels of the given AssignmentState by simulated
+    annealing until the time budget (in seconds) is used up. A random move is
+    made if it does not increase the interference, otherwise with a probability
+    that decreases with the temperature, which is lowered geometrically from
+    start_temperature to end_temperature over the time budget. The state is
+    left at the best assignment found. Returns its overall interference.
+
+    """
+    rand = random.Random(seed)
+    total = state.get_total_interference()
+    best_total = total
+    undo = list()
+    start_time = time.time()
+    temperature = start_temperature
+    iteration = 0
+    while best_total > EPSILON:
+        iteration += 1
+        if iteration % CHECK_INTERVAL == 0:
+            elapsed = time.time() - start_time
+            if elapsed > time_budget:
+                break
+            temperature = start_temperature * \
+                (float(end_temperature) / start_temperature) ** (elapsed / time_budget)
+        vertex = state.get_random_vertex(rand)
+        channel = rand.choice(state.channels)
+        if channel == state.channel[vertex] or not state.is_allowed(vertex, channel):
+            continue
+        delta = state.get_delta(vertex, channel)
+        if delta > EPSILON and rand.random() >= math.exp(-delta / temperature):
+            continue
+        undo.append((vertex, state.channel[vertex]))
+        state.move(vertex, channel)
+        total += delta
+        if total < best_total - EPSILON:
+            best_total = total
+            undo = list()
+    for vertex, channel in reversed(undo):
+        state.move(vertex, channel)
+    return best_total
+
+
+# optimization methods by name
+METHODS = {"tabu": tabu_search, "annealing": simulated_annealing}
+
+# Global variable to pass the AssignmentState to the worker processes of
+# optimize_assignment(..)
+_start_state = None
+
+
+def optimize_assignment(conflict_graph, channels, method="tabu",
+                        time_budget=TIME_BUDGET, radios=None, processes=1,
+                        seed=None):
+    """Assigns channels to the vertices of the conflict graph to minimize the
+    overall interference. The greedy improvement of greedy_assignment(..) is
+    followed by tabu search or simulated annealing (method "tabu" or
+    "annealing") for time_budget seconds. If processes is greater than 1, the
+    search is started in that many processes with different seeds and the
+    best result is kept. The channels are set in the network graph and the
+    conflict graph. Returns the list of vertices whose channel has changed.
+
+    """
+    global _start_state
+    if method not in METHODS:
+        raise CHANError("Unable to optimize channel assignment (unknown method %s)" % method)
+    state = AssignmentState(conflict_graph, channels, radios)
+    improve(state)
+    rand = random.Random(seed)
+    seeds = [rand.random() for i in range(max(processes, 1))]
+    if processes > 1:
+        # the workers inherit the state when they are forked
+        _start_state = state
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_optimize_start,
+                               [(method, time_budget, start_seed) for start_seed in seeds])
+        finally:
+            pool.terminate()
+            _start_state = None
+        best_total, best_channels = min(results)
+        for vertex, channel in zip(state.vertices, best_channels):
+            state.move(vertex, channel)
+    else:
+        METHODS[method](state, time_budget=time_budget, seed=seeds[0])
+    return state.apply()
+
+
+def _optimize_start(args):
+    """Runs a single start of optimize_assignment(..) in a worker process.
+    Returns the overall interference and the channels of the vertices.
+
+    """
+    method, time_budget, seed = args
+    total = METHODS[method](_start_state, time_budget=time_budget, seed=seed)
+    return total, [_start_state.channel[vertex] for vertex in _start_state.vertices]
+
+
+def naive_assignment(conflict_graph, channels):
+    """Assigns channels to the vertices of the conflict graph in a single pass,
+    trying every channel for every vertex with ConflictGraphVertex.set_channel(..)
+    and keeping the one with the lowest interference sum. This is the loop
+    algorithms used before this module existed, it serves as a reference for
+    benchmarks.
+
+    """
+    for vertex in conflict_graph.get_vertices():
+        best_channel = vertex.get_channel()
+        best_sum = conflict_graph.get_interference_sum()
+        for channel in channels:
+            vertex.set_channel(channel)
+            interference_sum = conflict_graph.get_interference_sum()
+            if interference_sum < best_sum:
+                best_channel = channel
+                best_sum = interference_sum
+        vertex.set_channel(best_channel)
+
+
+# this only runs if the module was *not* imported
+if __name__ == '__main__':
+    import argparse
+    from des_chan import des_db
+    from des_chan.graph import Graph, ConflictGraph
+    from des_chan.interference import co, two_hop, two_hop_frac
+    from des_chan.topology.etxd_sim import random_topology
+
+    models = {"two_hop": two_hop, "two_hop_frac": two_hop_frac, "co": co}
+    parser = argparse.ArgumentParser(description="Compares the channel assignment optimizers.")
+    parser.add_argument("--nodes", type=int, default=30)
+    parser.add_argument("--degree", type=float, default=6)
+    parser.add_argument("--channels", default="1,6,11,36,40,44,48")
+    parser.add_argument("--radios", type=int, default=3)
+    parser.add_argument("--model", choices=sorted(models.keys()), default="two_hop")
+    parser.add_argument("--time-budget", type=float, default=2.0)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--interferer-ratio", type=float, default=0.1,
+                        help="share of node pairs above the COIM threshold (model co)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    channels = [int(channel) for channel in args.channels.split(",")]
+    topology = random_topology(args.nodes, args.degree, seed=args.seed)
+    if args.model == "co":
+        # synthetic CO measurement results of the nodes in a local database
+        rand = random.Random(args.seed)
+        measurements = dict()
+        for listener in topology.get_vertices():
+            for sender in topology.get_vertices():
+                if listener == sender:
+                    continue
+                if rand.random() < args.interferer_ratio:
+                    measurements[(listener, sender)] = rand.uniform(2.5, 10.0)
+                else:
+                    measurements[(listener, sender)] = rand.uniform(0.0, 1.5)
+        backend = des_db.SQLiteBackend()
+        backend.load_measurements(measurements)
+        des_db.set_backend(backend)
+    network_graph = Graph(topology.get_vertices())
+    for edge in topology.get_edges().keys():
+        network_graph.set_edge_value(edge, str(channels[0]), False)
+    network_graph.update_distances()
+
+    def run(name, function, *function_args):
+        conflict_graph = ConflictGraph(network_graph.copy(), models[args.model])
+        start_time = time.time()
+        function(conflict_graph, *function_args)
+        print "%-10s interference=%-8s time=%.3fs" % (name, conflict_graph.get_interference_sum(),
+                                                     time.time() - start_time)
+
+    print "%d links, initial interference %s" % (len(network_graph.get_edges()),
+        ConflictGraph(network_graph.copy(), models[args.model]).get_interference_sum())
+    run("naive", naive_assignment, channels)
+    run("greedy", greedy_assignment, channels, args.radios)
+    for method in sorted(METHODS.keys()):
+        run(method, optimize_assignment, channels, method, args.time_budget,
+            args.radios, args.processes, args.seed)
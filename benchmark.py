@@ -0,0 +1,384 @@
+#!/usr/bin/python -t
+"""
+DES-CHAN: A Framework for Channel Assignment Algorithms for Testbeds
+
+This module benchmarks the operations of Graph and ConflictGraph on synthetic
+topologies: grids, random geometric graphs, and testbed-like topologies of
+nodes with three radios in several buildings. Each topology size is measured
+in a separate process, which reports the peak memory usage after each
+operation and is terminated if it exceeds the time limit. The results are
+written as JSON, so the results of two versions can be compared.
+
+Usage example (measure and compare with the results of a previous version):
+
+    python benchmark.py --sizes 50,100,200 --output new.json
+    python benchmark.py --compare old.json new.json
+
+Authors:    Matthias Philipp <mphilipp@inf.fu-berlin.de>,
+            Felix Juraschek <fjuraschek@gmail.com>
+
+Copyright 2008-2013, Freie Universitaet Berlin (FUB). All rights reserved.
+
+These sources were developed at the Freie Universitaet Berlin,
+Computer Systems and Telematics / Distributed, embedded Systems (DES) group
+(http://cst.mi.fu-berlin.de, http://www.des-testbed.net)
+-------------------------------------------------------------------------------
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see http://www.gnu.org/licenses/ .
+--------------------------------------------------------------------------------
+For further information and questions please use the web site
+       http://www.des-testbed.net
+
+"""
+
+import json
+import math
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+from Queue import Empty
+
+from des_chan.graph import Graph, ConflictGraph
+from des_chan import des_db
+from des_chan.interference import co, two_hop, two_hop_frac
+
+# channels of the three radios of the testbed nodes
+CHANNELS = (14, 36, 40)
+# topology sizes (number of nodes) measured by default
+SIZES = (50, 100, 200, 500, 1000, 2000)
+# time limit (in seconds) for all operations of a topology size
+TIME_LIMIT = 120.0
+# number of vertices used for operations that are measured per vertex
+SAMPLE_SIZE = 5
+# average number of neighbors in random geometric graphs
+DEGREE = 6
+# nodes of the testbed-like topologies are placed in buildings with this many
+# nodes, links on channel 14 (2.4 GHz) have a longer range than on 5 GHz
+NODES_PER_BUILDING = 40
+RANGES = {14: 0.12, 36: 0.08, 40: 0.08}
+# nodes closer than this distance measure a channel occupancy above the COIM
+# threshold while the other one is sending
+CO_RANGE = 0.2
+
+MODELS = {"two_hop": two_hop, "two_hop_frac": two_hop_frac, "co": co}
+
+
+def grid_topology(num_nodes, seed=None):
+    """Returns a grid with about num_nodes nodes, in which each node is linked
+    to its horizontal and vertical neighbors on a random channel, and the
+    positions of the nodes.
+
+    """
+    rand = random.Random(seed)
+    side = int(math.ceil(math.sqrt(num_nodes)))
+    positions = dict()
+    for i in range(num_nodes):
+        positions[_get_node_name(i)] = (float(i % side) / side, float(i / side) / side)
+    graph = Graph(positions.keys())
+    for i in range(num_nodes):
+        for j in (i + 1, i + side):
+            if j < num_nodes and (j == i + side or j % side != 0):
+                graph.set_edge_value((_get_node_name(i), _get_node_name(j)),
+                                     rand.choice(CHANNELS), False)
+    return graph, positions
+
+
+def random_geometric_topology(num_nodes, degree=DEGREE, seed=None):
+    """Returns a random geometric graph with num_nodes nodes in the unit square,
+    whose links are assigned to random channels, and the positions of the
+    nodes. Nodes are linked if they are closer than the radius that yields
+    the given average degree.
+
+    """
+    rand = random.Random(seed)
+    positions = dict()
+    for i in range(num_nodes):
+        positions[_get_node_name(i)] = (rand.random(), rand.random())
+    radius = math.sqrt(float(degree) / (math.pi * num_nodes))
+    graph = Graph(positions.keys())
+    for v1, v2 in _get_close_pairs(positions, radius):
+        graph.set_edge_value((v1, v2), rand.choice(CHANNELS), False)
+    return graph, positions
+
+
+def testbed_topology(num_nodes, seed=None):
+    """Returns a topology that resembles the DES-Testbed and the positions of
+    the nodes. The nodes are placed on three floors of buildings in a row,
+    and two nodes are linked if one of their radios reaches the other node.
+    Each link uses one of the channels in range.
+
+    """
+    rand = random.Random(seed)
+    positions = dict()
+    for i in range(num_nodes):
+        building = i / NODES_PER_BUILDING
+        # buildings are 1.0 long and 0.1 apart, floors are 0.05 apart
+        positions[_get_node_name(i)] = (building * 1.1 + rand.uniform(0, 1.0),
+                                        rand.uniform(0, 0.2) + rand.randint(0, 2) * 0.05)
+    graph = Graph(positions.keys())
+    for v1, v2 in _get_close_pairs(positions, max(RANGES.values())):
+        distance = _get_distance(positions[v1], positions[v2])
+        channels = [channel for channel in CHANNELS if distance < RANGES[channel]]
+        graph.set_edge_value((v1, v2), rand.choice(channels), False)
+    return graph, positions
+
+
+TOPOLOGIES = {"grid": grid_topology,
+              "random_geometric": random_geometric_topology,
+              "testbed": testbed_topology}
+
+
+def _get_node_name(i):
+    """Returns the name of the i-th node, following the testbed convention.
+
+    """
+    return "t9-%03d" % i
+
+
+def _get_distance(position1, position2):
+    return math.sqrt((position1[0] - position2[0]) ** 2 + (position1[1] - position2[1]) ** 2)
+
+
+def _get_close_pairs(positions, radius):
+    """Returns the list of pairs of nodes that are closer than radius.
+
+    """
+    pairs = list()
+    # sort by x coordinate, so only nearby nodes have to be compared
+    ordered = sorted(positions.keys(), key=lambda node: positions[node][0])
+    for i, v1 in enumerate(ordered):
+        for v2 in ordered[i + 1:]:
+            if positions[v2][0] - positions[v1][0] > radius:
+                break
+            if _get_distance(positions[v1], positions[v2]) < radius:
+                pairs.append((v1, v2))
+    return pairs
+
+
+def load_measurements(positions, seed=None):
+    """Stores CO measurement results for the nodes at the given positions in an
+    in-memory SQLite database and uses it as des_db backend. Nodes closer than
+    CO_RANGE measure a channel occupancy above the COIM threshold.
+
+    """
+    rand = random.Random(seed)
+    backend = des_db.SQLiteBackend()
+    measurements = dict()
+    for listener in positions.keys():
+        for sender in positions.keys():
+            if listener == sender:
+                continue
+            if _get_distance(positions[listener], positions[sender]) < CO_RANGE:
+                measurements[(listener, sender)] = rand.uniform(2.5, 10.0)
+            else:
+                measurements[(listener, sender)] = rand.uniform(0.0, 1.5)
+    backend.load_measurements(measurements)
+    des_db.set_backend(backend)
+
+
+def run_case(topology, num_nodes, model, seed, queue):
+    """Measures the operations on a topology of the given type and size and
+    puts a result dictionary for each operation into the queue. The Graph
+    operations are measured if model is None, otherwise the ConflictGraph
+    operations under the given interference model. Runs in a separate process,
+    so the peak memory usage can be attributed.
+
+    """
+    graph, positions = TOPOLOGIES[topology](num_nodes, seed)
+    info = {"topology": topology, "nodes": num_nodes,
+            "links": len(graph.get_edges()), "model": model}
+    rand = random.Random(seed)
+    vertices = sorted(graph.get_vertices())
+    sample = rand.sample(vertices, min(SAMPLE_SIZE, len(vertices)))
+    edges = graph.get_edges()
+
+    def build():
+        new_graph = Graph(vertices)
+        for edge, value in edges.items():
+            new_graph.set_edge_value(edge, value, False)
+        return new_graph
+
+    if model is None:
+        _measure(queue, info, "graph_build", build)
+        _measure(queue, info, "get_edges", graph.get_edges)
+        _measure(queue, info, "get_neighbors",
+                 lambda: [graph.get_neighbors(vertex) for vertex in sample], len(sample))
+        _measure(queue, info, "update_distances", graph.update_distances)
+        _measure(queue, info, "copy", graph.copy)
+        return
+    graph.update_distances()
+    # the network graph for ConflictGraph.update(..) lacks one link and has a
+    # new one
+    new_graph = graph.copy_fast()
+    removed = rand.choice(sorted(edges.keys()))
+    new_graph.set_edge_value(removed, None, False)
+    unlinked = [(v1, v2) for v1 in sample for v2 in vertices
+                if v1 != v2 and not edges.get((v1, v2)) and not edges.get((v2, v1))]
+    if unlinked:
+        new_graph.set_edge_value(rand.choice(unlinked), rand.choice(CHANNELS), False)
+    new_graph.update_distances(reset=True)
+    if model == "co":
+        load_measurements(positions, seed)
+        # load the results before the conflict graph is measured
+        co.init(vertices)
+    conflict_graph = _measure(queue, info, "conflict_graph_build",
+                              ConflictGraph, 1, graph.copy_fast(), MODELS[model])
+    cg_sample = rand.sample(sorted(conflict_graph.get_vertices(), key=str),
+                            min(SAMPLE_SIZE, len(conflict_graph.get_vertices())))
+    _measure(queue, info, "set_channel",
+             lambda: [vertex.set_channel(rand.choice(CHANNELS)) for vertex in cg_sample],
+             len(cg_sample))
+    _measure(queue, info, "get_interference_sum", conflict_graph.get_interference_sum)
+    _measure(queue, info, "update", conflict_graph.update, 1, new_graph.copy_fast())
+
+
+def _measure(queue, info, operation, function, calls=1, *args):
+    """Calls the function with the given arguments, puts the duration per call
+    and the peak memory usage of the process into the queue, and returns the
+    result of the function.
+
+    """
+    start_time = time.time()
+    result = function(*args)
+    duration = time.time() - start_time
+    measurement = dict(info)
+    measurement.update({"operation": operation,
+                        "seconds": duration / max(calls, 1),
+                        "calls": calls,
+                        # kilobytes on Linux
+                        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    queue.put(measurement)
+    return result
+
+
+def run_benchmark(topologies=None, sizes=SIZES, models=None, time_limit=TIME_LIMIT,
+                  seed=1):
+    """Measures all combinations of the given topology types and sizes. The
+    Graph operations and the ConflictGraph operations under each model run in
+    a new process, which is terminated after time_limit seconds. Returns a
+    list of result dictionaries, the operations that were not finished in
+    time are reported with "seconds" set to None.
+
+    """
+    if topologies is None:
+        topologies = sorted(TOPOLOGIES.keys())
+    if models is None:
+        models = sorted(MODELS.keys())
+    results = list()
+    for topology in topologies:
+        for num_nodes in sizes:
+            for model in [None] + list(models):
+                case_results = _run_process(topology, num_nodes, model, seed, time_limit)
+                for result in case_results:
+                    print >> sys.stderr, _format_result(result)
+                results += case_results
+    return results
+
+
+def _run_process(topology, num_nodes, model, seed, time_limit):
+    """Runs run_case(..) in a new process and returns its results.
+
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_case,
+                                      args=(topology, num_nodes, model, seed, queue))
+    process.start()
+    end_time = time.time() + time_limit
+    results = list()
+    while True:
+        try:
+            results.append(queue.get(timeout=0.1))
+            continue
+        except Empty:
+            pass
+        if not process.is_alive() or time.time() > end_time:
+            break
+    timed_out = process.is_alive()
+    if timed_out:
+        process.terminate()
+    process.join()
+    if timed_out or process.exitcode != 0:
+        results.append({"topology": topology, "nodes": num_nodes, "model": model,
+                        "operation": "timeout" if timed_out else "error",
+                        "seconds": None})
+    return results
+
+
+def compare(old_results, new_results):
+    """Returns a list of lines that compare the durations of the operations in
+    two benchmark results.
+
+    """
+    def get_key(result):
+        return (result["topology"], result["nodes"], result["model"] or "-",
+                result["operation"])
+    old = dict([(get_key(result), result) for result in old_results])
+    lines = list()
+    for result in new_results:
+        key = get_key(result)
+        if key not in old or not old[key]["seconds"] or result["seconds"] is None:
+            continue
+        lines.append("%-16s %5d %-12s %-20s %10.6fs %10.6fs %6.2fx" %
+                     (key + (old[key]["seconds"], result["seconds"],
+                             result["seconds"] / old[key]["seconds"])))
+    return lines
+
+
+def _format_result(result):
+    text = "%s %d %s %s" % (result["topology"], result["nodes"],
+                            result["model"] or "-", result["operation"])
+    if result["seconds"] is None:
+        return text
+    return text + " %.6fs %dkB" % (result["seconds"], result["max_rss"])
+
+
+# this only runs if the module was *not* imported
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks the graph and conflict graph operations.")
+    parser.add_argument("--topologies", default=",".join(sorted(TOPOLOGIES.keys())))
+    parser.add_argument("--sizes", default=",".join([str(size) for size in SIZES]))
+    parser.add_argument("--models", default=",".join(sorted(MODELS.keys())))
+    parser.add_argument("--time-limit", type=float, default=TIME_LIMIT,
+                        help="seconds per topology size")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="e.g. the version that is measured")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        old_file, new_file = [open(file_name) for file_name in args.compare]
+        for line in compare(json.load(old_file)["results"], json.load(new_file)["results"]):
+            print line
+        sys.exit(0)
+
+    results = run_benchmark(args.topologies.split(","),
+                            [int(size) for size in args.sizes.split(",")],
+                            args.models.split(","), args.time_limit, args.seed)
+    report = {"label": args.label,
+              "timestamp": time.time(),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "seed": args.seed,
+              "time_limit": args.time_limit,
+              "results": results}
+    if args.output:
+        output = open(args.output, 'w')
+        json.dump(report, output, indent=1, sort_keys=True)
+        output.close()
+    else:
+        print json.dumps(report, indent=1, sort_keys=True)
@@ -5,10 +5,22 @@ DES-CHAN: A Framework for Channel Assignment Algorithms for Testbeds
 des_db - A simple interface to access the database of the DES-Testbed, which
 stores information about the network nodes. This is a stripped version of the 
 testbed management system (TBMS) that only supports to run raw queries via the
-_raw_query(..) function.
+_raw_query(..) function and parameterized queries via the query(..) function.
+The results of parameterized queries can optionally be cached, see
+enable_cache(..).
 
-The module uses PgSQL - A PyDB-SIG 2.0 compliant module to access the PostgreSQL
-database. The latter is included in the Debian package python-pgsql.
+The database is accessed through a backend object. By default, the PostgreSQL
+database of the DES-Testbed is used (PgSQLBackend). For offline experiments
+and benchmarks, the SQLiteBackend provides a local database with the same
+"Node"/"CORResultsKernel" schema that can be filled with synthetic
+measurement data, see set_backend(..).
+
+Applications running on the Twisted reactor should use the deferred_*
+functions, which run the database work in a separate thread and return
+Deferreds, so the reactor is not blocked.
+
+The PgSQLBackend uses PgSQL - A PyDB-SIG 2.0 compliant module to access the
+PostgreSQL database. The latter is included in the Debian package python-pgsql.
 
 Authors:    Matthias Philipp <mphilipp@inf.fu-berlin.de>,
             Felix Juraschek <fjuraschek@gmail.com>
@@ -36,15 +48,27 @@ For further information and questions please use the web site
        
 """
 
-from os import path
-
+from collections import OrderedDict
+import random
+import re
+import sqlite3
+import threading
+import time
 
 try:
     from pyPgSQL import PgSQL
 except ImportError:
-    raise ImportError("You need to install PgSQL - A PyDB-SIG 2.0 compliant "\
-                      "module for PostgreSQL.\nIt is included in the Debian "\
-                      "package python-pgsql.")
+    # only required by the PgSQLBackend
+    PgSQL = None
+
+try:
+    # the reactor is imported where it is needed, so importing this module
+    # does not install the default reactor
+    from twisted.internet import threads
+    from twisted.python.threadpool import ThreadPool
+except ImportError:
+    # only required by the deferred_* functions
+    threads = None
 
 
 class Error(Exception):
@@ -56,8 +80,397 @@ _HOST = "host"
 _DATABASE = "db_name"
 _USER = "db_user"
 _PASSWORD = "db_pwd"
-# Global variable to store the PgSQL.connection object
-_connection = None
+# Global variable to store the backend object, the PgSQLBackend is used if
+# no other backend has been set
+_backend = None
+# Default settings for the query result cache
+_CACHE_TTL = 300
+_CACHE_SIZE = 1024
+# Maximum number of prepared statements per connection of the PgSQLBackend,
+# statements with IN lists are distinct for every list length
+_PREPARED_SIZE = 64
+# Global variable to store the _QueryCache object, None if caching is disabled
+_cache = None
+# Serializes the access to the backend, which may be shared by the reactor
+# thread and the database thread
+_lock = threading.RLock()
+# Global variable to store the ThreadPool of the deferred_* functions
+_threadpool = None
+
+
+class _QueryCache:
+    """Caches query results by statement and parameters. Entries expire after
+    ttl seconds, and the least recently used entry is evicted if more than
+    max_size entries are stored.
+
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """Returns the cached rows for the given key, or None if there is no
+        valid entry.
+
+        """
+        with self.lock:
+            try:
+                expires, rows = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # re-insert to mark the entry as most recently used
+            self.entries[key] = (expires, rows)
+            return rows
+
+
+    def put(self, key, rows):
+        """Stores the rows for the given key.
+
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, rows)
+            while len(self.entries) > self.max_size:
+                # the first entry is the least recently used one
+                self.entries.popitem(last=False)
+
+
+    def clear(self):
+        """Removes all entries.
+
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+class PgSQLBackend:
+    """Accesses the PostgreSQL database of the DES-Testbed.
+
+    """
+
+    def __init__(self, host="", database="", user="", password=""):
+        if PgSQL is None:
+            raise ImportError("You need to install PgSQL - A PyDB-SIG 2.0 compliant "\
+                              "module for PostgreSQL.\nIt is included in the Debian "\
+                              "package python-pgsql.")
+        # Use the default values for the connection, if the parameters are not given
+        self.host = host or _HOST
+        self.database = database or _DATABASE
+        self.user = user or _USER
+        self.password = password or _PASSWORD
+        # PgSQL.connection object
+        self.connection = None
+        # Prepared statements of the current connection (statement -> name),
+        # the least recently used one is deallocated if there are more than
+        # _PREPARED_SIZE
+        self.prepared = OrderedDict()
+        # number of statements prepared so far, used for unique names
+        self.num_prepared = 0
+
+
+    def connect(self):
+        """Opens the connection to the database.
+
+        """
+        self.prepared.clear()
+        # Make a connection to the database and check to see if it succeeded.
+        try:
+            self.connection = PgSQL.connect(host=self.host, database=self.database,
+                                            user=self.user, password=self.password)
+        except PgSQL.Error, msg:
+            errstr = "Connection to database '%s' failed\n%s" % (self.database, msg)
+            raise Error(errstr.strip())
+
+
+    def disconnect(self):
+        """Closes the connection to the database.
+
+        """
+        self.prepared.clear()
+        self.connection.close()
+        self.connection = None
+
+
+    def raw_query(self, stmt):
+        """Executes the given SQL statement, see _raw_query(..).
+
+        """
+        # Connect to the database if necessary
+        if self.connection is None:
+            self.connect()
+        # Create a Cursor object.  This handles the transaction block and the
+        # declaration of the database cursor.  
+        cursor = self.connection.cursor() 
+        # Try to execute the INSERT statement
+        try:
+            cursor.execute(stmt)
+        except PgSQL.Error, msg:
+            errstr = "Following statement failed:\n%s\n%s" % (stmt, msg)
+            raise Error(errstr.strip())
+        return self._fetch_rows(cursor)
+
+
+    def query(self, stmt, params):
+        """Executes the given SQL statement with the given parameters as
+        prepared statement, see query(..).
+
+        """
+        # Connect to the database if necessary
+        if self.connection is None:
+            self.connect()
+        cursor = self.connection.cursor()
+        try:
+            name = self.prepared.pop(stmt, None)
+            if name is None:
+                name = self._prepare(cursor, stmt)
+            # re-insert to mark the statement as most recently used
+            self.prepared[stmt] = name
+            if params:
+                placeholders = ", ".join(["%s"] * len(params))
+                cursor.execute("EXECUTE %s (%s)" % (name, placeholders), params)
+            else:
+                cursor.execute("EXECUTE %s" % name)
+        except PgSQL.Error, msg:
+            # the failed statement aborts the transaction
+            self.connection.rollback()
+            errstr = "Following statement failed:\n%s\n%s\n%s" % (stmt, params, msg)
+            raise Error(errstr.strip())
+        return self._fetch_rows(cursor)
+
+
+    def _prepare(self, cursor, stmt):
+        """Creates a prepared statement for the given SQL statement on the
+        current connection and returns its name. The least recently used
+        statements are deallocated to keep at most _PREPARED_SIZE.
+
+        """
+        while len(self.prepared) >= _PREPARED_SIZE:
+            # the first entry is the least recently used one
+            old_stmt, old_name = self.prepared.popitem(last=False)
+            cursor.execute("DEALLOCATE %s" % old_name)
+        name = "des_chan_%d" % self.num_prepared
+        self.num_prepared += 1
+        # PostgreSQL references the parameters of prepared statements by $n
+        counter = [0]
+        def number(match):
+            counter[0] += 1
+            return "$%d" % counter[0]
+        cursor.execute("PREPARE %s AS %s" % (name, re.sub("%s", number, stmt)))
+        return name
+
+
+    def _fetch_rows(self, cursor):
+        """Fetches all result rows from the given cursor, closes it and commits
+        the transaction.
+
+        """
+        # List that contains a dictionary with column name and data for each result row
+        data = list()
+        # Get the first result row
+        result = cursor.fetchone()
+        # as long as there are result rows available
+        while result is not None:
+            # dictionary for this row
+            row = dict()
+            # add the column name and data for each column of this result row
+            for column in result.description():
+                row.update({column[0]: eval("result.%s" % column[0])})
+            # append the dictionary from this row to the list of rows
+            data.append(row)
+            # Get the next result row
+            result = cursor.fetchone()
+        # Close the cursor
+        cursor.close()
+        # Commit the transaction
+        self.connection.commit()
+        return data
+
+
+class SQLiteBackend:
+    """Local stand-in for the testbed database. It provides the "Node" and
+    "CORResultsKernel" tables of the DES database, so the modules of the
+    framework can be run and benchmarked without access to the testbed. By
+    default, the database is kept in memory.
+
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS "Node" (
+               id INTEGER PRIMARY KEY,
+               name TEXT NOT NULL UNIQUE,
+               type INTEGER NOT NULL DEFAULT 0)""",
+        """CREATE TABLE IF NOT EXISTS "CORResultsKernel" (
+               id INTEGER PRIMARY KEY,
+               id_listener INTEGER NOT NULL REFERENCES "Node" (id),
+               id_sender INTEGER NOT NULL REFERENCES "Node" (id),
+               cot_max REAL NOT NULL,
+               timestamp REAL NOT NULL DEFAULT 0,
+               UNIQUE (id_listener, id_sender))""",
+    ]
+
+    def __init__(self, database=":memory:"):
+        self.database = database
+        self.connection = None
+
+
+    def connect(self):
+        """Opens the database and creates the tables if necessary.
+
+        """
+        try:
+            # the connection is used by the reactor thread and the database
+            # thread, the access is serialized by the module
+            self.connection = sqlite3.connect(self.database, check_same_thread=False)
+            for stmt in self.SCHEMA:
+                self.connection.execute(stmt)
+            self.connection.commit()
+        except sqlite3.Error, msg:
+            errstr = "Connection to database '%s' failed\n%s" % (self.database, msg)
+            raise Error(errstr.strip())
+
+
+    def disconnect(self):
+        """Closes the database. Note, that an in-memory database is discarded.
+
+        """
+        self.connection.close()
+        self.connection = None
+
+
+    def raw_query(self, stmt):
+        """Executes the given SQL statement, see _raw_query(..).
+
+        """
+        return self._execute(stmt, ())
+
+
+    def query(self, stmt, params):
+        """Executes the given SQL statement with the given parameters, see
+        query(..). sqlite3 keeps compiled statements in its own statement cache.
+
+        """
+        # sqlite3 uses the qmark parameter style
+        return self._execute(stmt.replace("%s", "?"), params)
+
+
+    def add_node(self, name, node_type=0):
+        """Adds a node with the given name to the "Node" table, if it does not
+        exist yet, and returns its id.
+
+        """
+        if self.connection is None:
+            self.connect()
+        rows = self.connection.execute('SELECT id FROM "Node" WHERE name = ?',
+                                       (name,)).fetchall()
+        if rows:
+            return rows[0][0]
+        cursor = self.connection.execute('INSERT INTO "Node" (name, type) VALUES (?, ?)',
+                                         (name, node_type))
+        self.connection.commit()
+        return cursor.lastrowid
+
+
+    def load_measurements(self, measurements):
+        """Stores the given CO measurement results. measurements maps
+        (listener, sender) tuples of node names to the measured cot_max value.
+        Missing nodes are added to the "Node" table, existing results for a
+        node pair are replaced. The timestamp column of all stored rows is set
+        to the current time.
+
+        A node does not sense itself, so a cot_max of 0 is stored for each node
+        and itself, unless given. co.get_interference(..) looks these results
+        up for links that share an end node.
+
+        """
+        measurements = dict(measurements)
+        node_ids = dict()
+        for listener, sender in measurements.keys():
+            for name in (listener, sender):
+                if name not in node_ids:
+                    node_ids[name] = self.add_node(name)
+        for name in node_ids.keys():
+            measurements.setdefault((name, name), 0.0)
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO "CORResultsKernel" (id_listener, id_sender, cot_max, timestamp) VALUES (?, ?, ?, ?)',
+            [(node_ids[listener], node_ids[sender], cot_max, now)
+             for (listener, sender), cot_max in measurements.items()])
+        self.connection.commit()
+
+
+    def load_synthetic_measurements(self, num_nodes, interferer_ratio=0.1,
+                                    max_cot=10.0, prefix="t9-", seed=None):
+        """Generates and stores CO measurement results for num_nodes nodes.
+        Every node listens to every other node, interferer_ratio of the pairs
+        show a channel occupancy above the COIM threshold. Returns the list of
+        generated node names.
+
+        """
+        rand = random.Random(seed)
+        names = ["%s%03d" % (prefix, i) for i in range(num_nodes)]
+        measurements = dict()
+        for listener in names:
+            for sender in names:
+                if listener == sender:
+                    continue
+                if rand.random() < interferer_ratio:
+                    # above the threshold of 2.0 percent
+                    cot_max = rand.uniform(2.5, max_cot)
+                else:
+                    cot_max = rand.uniform(0.0, 1.5)
+                measurements[(listener, sender)] = cot_max
+        self.load_measurements(measurements)
+        return names
+
+
+    def _execute(self, stmt, params):
+        """Executes the statement and returns the result rows as list of
+        dictionaries.
+
+        """
+        if self.connection is None:
+            self.connect()
+        try:
+            cursor = self.connection.execute(stmt, params)
+        except sqlite3.Error, msg:
+            errstr = "Following statement failed:\n%s\n%s\n%s" % (stmt, params, msg)
+            raise Error(errstr.strip())
+        data = list()
+        if cursor.description is not None:
+            columns = [column[0] for column in cursor.description]
+            for result in cursor:
+                data.append(dict(zip(columns, result)))
+        cursor.close()
+        self.connection.commit()
+        return data
+
+
+def set_backend(backend):
+    """Sets the backend that is used by the functions of this module, e.g.
+    set_backend(SQLiteBackend()) to work with a local in-memory database.
+    Cached query results of the previous backend are discarded.
+
+    """
+    global _backend
+    _backend = backend
+    clear_cache()
+
+
+def get_backend():
+    """Returns the backend that is currently used. If no backend has been set,
+    the PgSQLBackend for the DES database is created.
+
+    """
+    global _backend
+    if _backend is None:
+        _backend = PgSQLBackend()
+    return _backend
 
 
 def _connect(host="", database="", user="", password=""):
@@ -72,23 +485,9 @@ def _connect(host="", database="", user="", password=""):
     connection.
 
     """
-    global _connection
-    # Use the default values for the connection, if the parameters are not given
-    if host == "":
-        host = _HOST
-    if database == "":
-        database = _DATABASE
-    if user == "":
-        user = _USER
-    if password == "":
-        password = _PASSWORD
-    # Make a connection to the database and check to see if it succeeded.
-    try:
-        _connection = PgSQL.connect(host=host, database=database, user=user,\
-                                    password=password)
-    except PgSQL.Error, msg:
-        errstr = "Connection to database '%s' failed\n%s" % (_DATABASE, msg)
-        raise Error(errstr.strip())
+    backend = PgSQLBackend(host, database, user, password)
+    backend.connect()
+    set_backend(backend)
 
 
 def _disconnect():
@@ -99,9 +498,7 @@ def _disconnect():
     PgSQL.connection object.
 
     """
-    global _connection
-    _connection.close()
-    _connection = None
+    get_backend().disconnect()
 
 
 def _raw_query(stmt):
@@ -112,36 +509,108 @@ def _raw_query(stmt):
     selected values as values.
 
     """
-    # Connect to the database if necessary
-    if _connection is None:
-        _connect()
-    # Create a Cursor object.  This handles the transaction block and the
-    # declaration of the database cursor.  
-    cursor = _connection.cursor() 
-    # Try to execute the INSERT statement
-    try:
-        cursor.execute(stmt)
-    except PgSQL.Error, msg:
-        errstr = "Following statement failed:\n%s\n%s" % (stmt, msg)
-        raise Error(errstr.strip())
-    # List that contains a dictionary with column name and data for each result row
-    data = list()
-    # Get the first result row
-    result = cursor.fetchone()
-    # as long as there are result rows available
-    while result is not None:
-        # dictionary for this row
-        row = dict()
-        # add the column name and data for each column of this result row
-        for column in result.description():
-            row.update({column[0]: eval("result.%s" % column[0])})
-        # append the dictionary from this row to the list of rows
-        data.append(row)
-        # Get the next result row
-        result = cursor.fetchone()
-    # Close the cursor
-    cursor.close()
-    # Commit the transaction
-    _connection.commit()
-    return data
+    with _lock:
+        return get_backend().raw_query(stmt)
+
+
+def query(stmt, params=(), cache=True):
+    """Executes the given SQL statement with the given parameters.
 
+    Parameters are referenced by %s placeholders in the statement and are
+    passed separately, so they never have to be quoted by the caller, e.g.
+    query("SELECT id FROM \"Node\" WHERE name = %s", ("t9-035",)). Each
+    distinct statement is prepared once per connection and executed with the
+    given parameters afterwards. The PgSQLBackend keeps the most recently used
+    statements prepared.
+
+    The result has the same format as the one of _raw_query(..). If the result
+    cache is enabled and cache is True, the result is looked up in the cache
+    before the database is queried.
+
+    """
+    params = tuple(params)
+    key = (stmt, params)
+    if cache and _cache is not None:
+        rows = _cache.get(key)
+        if rows is not None:
+            return [dict(row) for row in rows]
+    with _lock:
+        rows = get_backend().query(stmt, params)
+    if cache and _cache is not None:
+        _cache.put(key, rows)
+        return [dict(row) for row in rows]
+    return rows
+
+
+def enable_cache(ttl=_CACHE_TTL, max_size=_CACHE_SIZE):
+    """Enables the result cache for query(..). Results are kept for ttl seconds
+    and at most max_size results are cached. Calling this function again
+    discards all cached results.
+
+    """
+    global _cache
+    _cache = _QueryCache(ttl, max_size)
+
+
+def disable_cache():
+    """Disables the result cache for query(..) and discards all cached results.
+
+    """
+    global _cache
+    _cache = None
+
+
+def clear_cache():
+    """Discards all cached results, e.g. after new measurements have been
+    stored in the database.
+
+    """
+    if _cache is not None:
+        _cache.clear()
+
+
+def deferred_raw_query(stmt):
+    """Executes the given SQL statement in the database thread. Returns a
+    Deferred that fires with the result of _raw_query(..).
+
+    """
+    return deferred_call(_raw_query, stmt)
+
+
+def deferred_query(stmt, params=(), cache=True):
+    """Executes the given SQL statement with the given parameters in the
+    database thread. Returns a Deferred that fires with the result of
+    query(..).
+
+    """
+    return deferred_call(query, stmt, params, cache)
+
+
+def deferred_call(function, *args, **kwargs):
+    """Calls the given function in the database thread and returns a Deferred
+    that fires with its result. This way, functions that issue several queries
+    do not block the reactor.
+
+    All database work of the deferred_* functions is done by a single thread,
+    since the database connections must not be used concurrently.
+
+    """
+    from twisted.internet import reactor
+    return threads.deferToThreadPool(reactor, _get_threadpool(), function,
+                                     *args, **kwargs)
+
+
+def _get_threadpool():
+    """Returns the thread pool for the database work and starts it if
+    necessary. The pool is stopped when the reactor shuts down.
+
+    """
+    global _threadpool
+    if threads is None:
+        raise ImportError("You need to install Twisted to use the deferred_* functions.")
+    if _threadpool is None:
+        from twisted.internet import reactor
+        _threadpool = ThreadPool(1, 1, "des_db")
+        _threadpool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _threadpool.stop)
+    return _threadpool
@@ -30,6 +30,8 @@ For further information and questions please use the web site
        
 """
 
+import heapq
+import multiprocessing
 import re
 import sys
 
@@ -40,6 +42,9 @@ class Graph:
         # initialize internal data structures
         self.values = dict()
         self.distances = dict()
+        # link weights (e.g. ETX values) are stored separately from the edge
+        # values and only for edges that have a weight
+        self.weights = dict()
         # set vertex names and distances
         for vertex in vertices:
             self.add_vertex(vertex)
@@ -71,6 +76,8 @@ class Graph:
         for v in self.get_vertices():
             del self.values[v][vertex]
             del self.distances[v][vertex]
+        for v in self.weights.pop(vertex, {}).keys():
+            self._remove_weight(v, vertex)
 
 
     def get_vertices(self):
@@ -89,6 +96,10 @@ class Graph:
         self.values[v1][v2] = value
         # we implement an undirected graph
         self.values[v2][v1] = value
+        # a removed edge has no weight
+        if not value and v1 in self.weights and v2 in self.weights[v1]:
+            self._remove_weight(v1, v2)
+            self._remove_weight(v2, v1)
         # update distance information
         # None, "", False, and 0 correspond to no edge
         if value:
@@ -123,6 +134,83 @@ class Graph:
         return self.distances[v1][v2]
 
 
+    def set_edge_weight(self, edge, weight):
+        """Sets the weight of the given edge, e.g. its ETX value. The weight is
+        independent of the edge value. If weight is None, the weight of the
+        edge is removed.
+
+        """
+        v1, v2 = edge
+        if weight is None:
+            self._remove_weight(v1, v2)
+            self._remove_weight(v2, v1)
+            return
+        self.weights.setdefault(v1, dict())[v2] = weight
+        # we implement an undirected graph
+        self.weights.setdefault(v2, dict())[v1] = weight
+
+
+    def get_edge_weight(self, edge, default=1):
+        """Returns the weight of the given edge, or the default weight if the
+        edge has no weight.
+
+        """
+        v1, v2 = edge
+        return self.weights.get(v1, {}).get(v2, default)
+
+
+    def get_shortest_paths(self, source, max_distance=None):
+        """Returns a dictionary that contains the length of the shortest path
+        from the source to each reachable vertex, where the length is the sum
+        of the edge weights. Edges without weight count as 1, so the lengths
+        are hop counts for unweighted graphs. If max_distance is given, only
+        vertices within that distance are returned.
+
+        """
+        lengths = dict()
+        heap = [(0, source)]
+        while heap:
+            length, v1 = heapq.heappop(heap)
+            if v1 in lengths:
+                continue
+            if max_distance is not None and length > max_distance:
+                break
+            lengths[v1] = length
+            for v2, value in self.values[v1].iteritems():
+                # None, "", False, and 0 correspond to no edge
+                if value and v2 not in lengths:
+                    heapq.heappush(heap, (length + self.get_edge_weight((v1, v2)), v2))
+        return lengths
+
+
+    def get_shortest_path(self, source, target):
+        """Returns a tuple of the length of the shortest path between source and
+        target, where the length is the sum of the edge weights, and the list
+        of vertices along the path. If target is not reachable, (None, []) is
+        returned.
+
+        """
+        # vertex -> predecessor on the shortest path from source
+        predecessors = dict()
+        heap = [(0, source, None)]
+        while heap:
+            length, v1, predecessor = heapq.heappop(heap)
+            if v1 in predecessors:
+                continue
+            predecessors[v1] = predecessor
+            if v1 == target:
+                path = [v1]
+                while predecessors[path[-1]] is not None:
+                    path.append(predecessors[path[-1]])
+                path.reverse()
+                return length, path
+            for v2, value in self.values[v1].iteritems():
+                if value and v2 not in predecessors:
+                    heapq.heappush(heap, (length + self.get_edge_weight((v1, v2)),
+                                          v2, v1))
+        return None, []
+
+
     def get_edges(self, get_all=False):
         """Returns a dictionary that contains all edges as keys and the
         corresponding edge values as values. Only edges that have a value are
@@ -157,9 +245,35 @@ class Graph:
         # set edge values
         for edge, edge_value in graph.get_edges().items():
             self.set_edge_value(edge, edge_value, False)
+            if edge[1] in graph.weights.get(edge[0], {}):
+                self.set_edge_weight(edge, graph.get_edge_weight(edge))
         self.update_distances()
 
 
+    def diff(self, graph):
+        """Compares the edges of the given graph with the edges of this graph.
+        Returns a tuple of three dictionaries: the edges that only exist in the
+        given graph, the edges that only exist in this graph, and the edges
+        whose value differs. The dictionaries map the edges to their values in
+        the given graph, except for the removed edges, which are mapped to their
+        values in this graph.
+
+        """
+        added = dict()
+        changed = dict()
+        for (v1, v2), value in graph.get_edges().items():
+            old_value = self.values.get(v1, {}).get(v2)
+            if not old_value:
+                added[(v1, v2)] = value
+            elif old_value != value:
+                changed[(v1, v2)] = value
+        removed = dict()
+        for (v1, v2), value in self.get_edges().items():
+            if not graph.values.get(v1, {}).get(v2):
+                removed[(v1, v2)] = value
+        return added, removed, changed
+
+
     def get_adjacency_matrix(self):
         """Returns the graph's adjacency matrix as a formatted string.
 
@@ -283,11 +397,22 @@ class Graph:
         self.update_distances()
 
 
-    def update_distances(self):
+    def update_distances(self, reset=False):
         """Updates the distance matrix with the number of hops between all
-        vertex pairs.
+        vertex pairs. Distances only decrease by an update, so if edges have
+        been removed, reset has to be True to recalculate all distances from
+        the edges.
 
         """
+        if reset:
+            for v1 in self.get_vertices():
+                for v2 in self.get_vertices():
+                    if v1 == v2:
+                        self.distances[v1][v2] = 0
+                    elif self.values[v1][v2]:
+                        self.distances[v1][v2] = 1
+                    else:
+                        self.distances[v1][v2] = sys.maxint
         # Floyd Warshall algorithm
         # calculate all shortest paths
         for k in self.get_vertices():
@@ -324,6 +449,7 @@ class Graph:
                 g.set_edge_value((v1, v2), self.get_edge_value((v1, v2)))
                 g.set_distance(v1, v2, self.get_distance(v1, v2))
             remaining_vertices.remove(v1)
+        g.copy_weights(self)
         return g
 
 
@@ -337,9 +463,31 @@ class Graph:
         for (v1, v2), chans in self.get_edges().iteritems():
             g.set_edge_value((v1,v2), self.get_edge_value((v1, v2)), update=False)
             g.set_distance(v1, v2, self.get_distance(v1, v2))
+        g.copy_weights(self)
         return g
 
 
+    def copy_weights(self, graph):
+        """Replaces the edge weights with those of the given graph. The edge
+        values and distances are not changed.
+
+        """
+        self.weights = dict()
+        for v1, weights in graph.weights.items():
+            self.weights[v1] = dict(weights)
+
+
+    def _remove_weight(self, v1, v2):
+        """Removes the weight of the directed pair v1, v2.
+
+        """
+        weights = self.weights.get(v1)
+        if weights is not None:
+            weights.pop(v2, None)
+            if not weights:
+                del self.weights[v1]
+
+
     def _get_edge_value_as_text(self, edge):
         """Returns a textual representation of the value of the given edge. The
         edge is represented by a tuple of two vertices.
@@ -399,12 +547,25 @@ class ConflictGraphVertex:
             return self.nw_graph_edge[0]
 
 
+# number of row blocks per process for the parallel conflict graph
+# construction, more blocks balance the load better
+BLOCKS_PER_PROCESS = 4
+
+# Global variables to pass the conflict graph and the ordered vertices to the
+# worker processes of ConflictGraph.update_edges()
+_parallel_graph = None
+_parallel_vertices = None
+
+
 class ConflictGraph(Graph):
 
-    def __init__(self, network_graph, interference_model):
+    def __init__(self, network_graph, interference_model, processes=1):
         # store the original network graph for later reference
         self.network_graph = network_graph
         self.interference_model = interference_model
+        # number of processes that evaluate the interference model in
+        # update_edges()
+        self.processes = processes
         vertices = set()
         # each edge in the network graph corresponds to a vertex in the conflict
         # graph
@@ -418,34 +579,87 @@ class ConflictGraph(Graph):
 
     def update_edges(self):
         """Updates all edges of the ConflictGraph regarding the current channel
-        assignment and the applied interference model.
+        assignment and the applied interference model. If more than one process
+        has been requested, the vertex pairs are evaluated in parallel.
 
         """
-        remaining_vertices = self.get_vertices()
-        for v1 in self.get_vertices():
-            for v2 in remaining_vertices:
+        if self.processes > 1:
+            self._update_edges_parallel()
+            return
+        vertices = self.get_ordered_vertices()
+        for i, v1 in enumerate(vertices):
+            # graph is undirected
+            for v2 in vertices[i:]:
                 # get edge value according to the interference model
                 value = self.interference_model.get_interference(self.network_graph,
                                                                  v1.nw_graph_edge,
                                                                  v2.nw_graph_edge)
                 self.set_edge_value((v1, v2), value, False)
-            # graph is undirected
-            remaining_vertices.remove(v1)
+
+
+    def _update_edges_parallel(self):
+        """Updates all edges like update_edges(), but splits the vertex pairs
+        into blocks of rows and evaluates them in a pool of worker processes.
+        The workers are forked, so they share the network graph and the data
+        cached by the interference model with this process, and only return
+        the edges that have a value.
+
+        """
+        global _parallel_graph, _parallel_vertices
+        vertices = self.get_ordered_vertices()
+        if not vertices:
+            return
+        # let the interference model load its data (e.g. the CO measurement
+        # results) before the workers are forked
+        self.interference_model.get_interference(self.network_graph,
+                                                 vertices[0].nw_graph_edge,
+                                                 vertices[0].nw_graph_edge)
+        _parallel_graph = self
+        _parallel_vertices = vertices
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            results = pool.map(_evaluate_rows,
+                               _get_row_blocks(len(vertices),
+                                               self.processes * BLOCKS_PER_PROCESS))
+        finally:
+            pool.terminate()
+            _parallel_graph = None
+            _parallel_vertices = None
+        # remove the old edges, pairs without interference are not returned
+        for v1, v2 in self.get_edges().keys():
+            self.set_edge_value((v1, v2), 0, False)
+        for block in results:
+            for i, j, value in block:
+                self.set_edge_value((vertices[i], vertices[j]), value, False)
 
 
     def update_edge(self, cg_vertex):
         """Updates all edges that are adjacent to the supplied cg_vertex.
 
         """
-        remaining_vertices = self.get_vertices()
         for v2 in self.get_vertices():
+            # evaluate the pair in the same direction as update_edges()
+            if v2.nw_graph_edge < cg_vertex.nw_graph_edge:
+                e1, e2 = v2.nw_graph_edge, cg_vertex.nw_graph_edge
+            else:
+                e1, e2 = cg_vertex.nw_graph_edge, v2.nw_graph_edge
             # get edge value according to the interference model
             value = self.interference_model.get_interference(self.network_graph,
-                                                                 cg_vertex.nw_graph_edge,
-                                                                 v2.nw_graph_edge)
+                                                             e1, e2)
             self.set_edge_value((cg_vertex, v2), value, False)
 
 
+    def get_ordered_vertices(self):
+        """Returns a list of the vertices sorted by their links. The interference
+        model is evaluated for each pair of vertices with the link of the first
+        vertex in this order as first link. This way, models that only consider
+        the end nodes of the first link as listeners, like COIM, yield the same
+        conflict graph regardless of the order of the vertices in memory.
+
+        """
+        return sorted(self.get_vertices(), key=lambda vertex: vertex.nw_graph_edge)
+
+
     def get_vertices_for_node(self, node_name):
         """Returns a set containing all vertices that correspond to links that
         are incident to the given node.
@@ -512,6 +726,45 @@ class ConflictGraph(Graph):
         self.update_edges()
 
 
+def _get_row_blocks(num_rows, num_blocks):
+    """Splits the rows of the upper triangle of a num_rows x num_rows matrix
+    into at most num_blocks blocks of consecutive rows with about the same
+    number of elements. Returns a list of (first row, end row) tuples.
+
+    """
+    total = num_rows * (num_rows + 1) / 2
+    blocks = list()
+    start = 0
+    elements = 0
+    for row in range(num_rows):
+        # row i contains the pairs (i, i), ..., (i, num_rows - 1)
+        elements += num_rows - row
+        if elements * num_blocks >= total * (len(blocks) + 1) or row == num_rows - 1:
+            blocks.append((start, row + 1))
+            start = row + 1
+    return blocks
+
+
+def _evaluate_rows(block):
+    """Evaluates the interference model for the vertex pairs in the given block
+    of rows in a worker process. Returns a list of (i, j, value) tuples of the
+    vertex indices and the interference value of the pairs that interfere.
+
+    """
+    first, end = block
+    graph = _parallel_graph
+    vertices = _parallel_vertices
+    get_interference = graph.interference_model.get_interference
+    results = list()
+    for i in range(first, end):
+        e1 = vertices[i].nw_graph_edge
+        for j in range(i, len(vertices)):
+            value = get_interference(graph.network_graph, e1, vertices[j].nw_graph_edge)
+            if value:
+                results.append((i, j, value))
+    return results
+
+
 # this only runs if the module was *not* imported
 if __name__ == '__main__':
     g = Graph(["a", "b", "c", "d", "e"])
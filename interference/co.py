@@ -42,27 +42,295 @@ from des_chan import des_db
 
 # Threshold for the sensed channel occupancy (in percent)
 CO_THRESHOLD = 2.0
+# Column of "CORResultsKernel" that records when a result was added or changed,
+# used by refresh() to fetch new results only
+WATERMARK_COLUMN = "timestamp"
 
 node_id = dict()
 cot_max = dict()
+# latest value of the watermark column seen by init() or refresh(), None if
+# unknown
+_watermark = None
+# names of the nodes whose results are cached, None if the results of all
+# nodes are cached
+_scope = None
+# Deferreds waiting for the running deferred_init(..), None if none is running
+_pending_init = None
 
 
-def init():
+def init(node_names=None):
     """Caches the CO measurement results into a data structure, so we can look up
     interference relationships faster without accessing the database.
+
+    By default, the results of all nodes of the testbed are cached. If a set of
+    node names is given, e.g. the vertices of the current network graph, only
+    the results between these nodes are cached. The scope is extended by
+    extend_scope(..), which is also called by get_interference(..) for links to
+    nodes outside the scope.
+
+    Raises a CHANError while deferred_init(..) is running.
     
     """
-	# get all nodes 
-    res_db = des_db._raw_query("SELECT id, name FROM \"Node\" WHERE  type = 0")
+    _check_pending_init()
+    _store_results(*_fetch_results(node_names))
+
+
+def deferred_init(node_names=None):
+    """Caches the CO measurement results like init(), but runs the database
+    queries in the database thread of des_db. Returns a Deferred that fires when
+    the results are available. Applications running on the Twisted reactor
+    should call this function before the first call of get_interference(..),
+    so the reactor is not blocked while the results are downloaded.
+
+    If the results are already being downloaded by a previous call, no further
+    download is started and the returned Deferred fires along with the
+    previous one. Until then, the functions that would cache the results
+    themselves, like get_interference(..), raise a CHANError.
+
+    """
+    global _pending_init
+    from twisted.internet import defer
+    d = defer.Deferred()
+    if _pending_init is not None:
+        _pending_init.append(d)
+        return d
+    load = des_db.deferred_call(_fetch_results, node_names)
+    _pending_init = [d]
+    load.addCallback(lambda results: _store_results(*results))
+    load.addCallbacks(_deferred_init_done, _deferred_init_done,
+                      callbackArgs=(True,), errbackArgs=(False,))
+    return d
+
+
+def _deferred_init_done(result, succeeded):
+    """Fires the Deferreds waiting for deferred_init(..).
+
+    """
+    global _pending_init
+    waiting = _pending_init
+    _pending_init = None
+    for d in waiting:
+        if succeeded:
+            d.callback(result)
+        else:
+            d.errback(result)
+
+
+def _check_pending_init():
+    """Raises a CHANError if deferred_init(..) is running, since the results
+    would be downloaded a second time and replaced when it finishes.
+
+    """
+    if _pending_init is not None:
+        raise CHANError("Unable to cache CO measurement results (deferred_init(..) is still running)")
+
+
+def extend_scope(node_names):
+    """Adds the CO measurement results of the given nodes to the cache, if only
+    the results of a subset of the nodes are cached. Only the results between
+    the new nodes and the nodes already in scope are fetched.
+
+    """
+    global _scope
+    if len(node_id) == 0:
+        init(node_names)
+        return
+    if _scope is None:
+        return
+    new_names = set(node_names) - _scope
+    if not new_names:
+        return
+    old_ids = _get_node_ids(_scope)
+    new_nodes = _fetch_nodes(new_names)
+    _store_nodes(new_nodes)
+    new_ids = [res.get('id') for res in new_nodes]
+    res_db = _fetch_results_between(new_ids, old_ids + new_ids)
+    res_db += _fetch_results_between(old_ids, new_ids)
+    _store_cot_max(res_db)
+    # unknown node names are kept in scope, so they are not queried again
+    _scope |= new_names
+
+
+def refresh():
+    """Updates the cached CO measurement results with the results that have
+    been added or changed in the database since the last call of init() or
+    refresh(). Returns a set of (listener, sender) tuples of the node names for
+    which the result changed. If only a subset of the nodes is cached, only
+    the results between these nodes are updated.
+
+    If the database does not provide the WATERMARK_COLUMN, all results are
+    fetched again, but still only the changed node pairs are returned.
+
+    """
+    global _watermark
+    changed = set()
+    if len(node_id) == 0:
+        _check_pending_init()
+        results = _fetch_results()
+        _store_results(*results)
+        # node names may contain '-', so the pairs are taken from the rows
+        # instead of the keys of cot_max
+        for res in results[3]:
+            changed.add((node_id[res.get('id_listener')], node_id[res.get('id_sender')]))
+        return changed
+    # new nodes may have been added to the testbed
+    _load_nodes()
+    watermark = _get_watermark()
+    stmt = "SELECT id_listener, id_sender, cot_max FROM \"CORResultsKernel\" WHERE 1 = 1"
+    params = list()
+    if _watermark is not None and watermark is not None:
+        # results with the old watermark might have been stored after the
+        # last sync, unchanged results are filtered below
+        stmt += " AND " + WATERMARK_COLUMN + " >= %s"
+        params.append(_watermark)
+    if _scope is not None:
+        ids = _get_node_ids(_scope)
+        if not ids:
+            return changed
+        stmt += " AND id_listener IN (%s) AND id_sender IN (%s)" % (_placeholders(ids), _placeholders(ids))
+        params += ids + ids
+    res_db = des_db.query(stmt, params, cache=False)
+    _watermark = watermark
+    for res in res_db:
+        listener = node_id[res.get('id_listener')]
+        sender = node_id[res.get('id_sender')]
+        key = listener + '-' + sender
+        if cot_max.get(key) != res.get('cot_max'):
+            cot_max[key] = res.get('cot_max')
+            changed.add((listener, sender))
+    return changed
+
+
+def get_affected_edges(graph, changed):
+    """Returns the set of edges of the given network graph whose interference
+    relationships may have changed with the CO results of the given node pairs,
+    e.g. as returned by refresh(). The conflict graph vertices of these edges
+    have to be updated.
+
+    """
+    nodes = set()
+    for listener, sender in changed:
+        nodes.add(listener)
+        nodes.add(sender)
+    edges = set()
+    for edge in graph.get_edges().keys():
+        if edge[0] in nodes or edge[1] in nodes:
+            edges.add(edge)
+    return edges
+
+
+def _load_nodes():
+    """Caches the ids and names of all nodes in scope.
+
+    """
+    _store_nodes(_fetch_nodes(_scope))
+
+
+def _fetch_nodes(node_names=None):
+    """Returns the ids and names of the given nodes from the database, or of all
+    nodes if no names are given.
+
+    """
+    if node_names is None:
+        # get all nodes 
+        return des_db.query("SELECT id, name FROM \"Node\" WHERE type = %s", (0,), cache=False)
+    node_names = list(node_names)
+    if not node_names:
+        return list()
+    return des_db.query("SELECT id, name FROM \"Node\" WHERE type = %s AND name IN (" \
+                        + _placeholders(node_names) + ")", [0] + node_names, cache=False)
+
+
+def _store_nodes(res_db):
+    """Caches the given node ids and names.
+
+    """
     for res in res_db:
         node_id[res.get('id')] = res.get('name')
 
+
+def _fetch_results(node_names=None):
+    """Returns the node names in scope, their ids and names, the current
+    watermark, and their CO measurement results from the database.
+
+    """
+    nodes = _fetch_nodes(node_names)
+    # remember the current watermark before the results are fetched, so results
+    # stored meanwhile are picked up by the next refresh
+    watermark = _get_watermark()
     # get the CO measurement results
-    res_db = des_db._raw_query("SELECT id_listener, id_sender, cot_max FROM \"CORResultsKernel\"")
+    if node_names is None:
+        res_db = des_db.query("SELECT id_listener, id_sender, cot_max FROM \"CORResultsKernel\"")
+    else:
+        ids = [res.get('id') for res in nodes]
+        res_db = _fetch_results_between(ids, ids)
+    return node_names, nodes, watermark, res_db
+
+
+def _fetch_results_between(listener_ids, sender_ids):
+    """Returns the CO measurement results of the given listeners for the given
+    senders from the database.
+
+    """
+    if not listener_ids or not sender_ids:
+        return list()
+    return des_db.query("SELECT id_listener, id_sender, cot_max FROM \"CORResultsKernel\" " \
+                        "WHERE id_listener IN (" + _placeholders(listener_ids) + ") " \
+                        "AND id_sender IN (" + _placeholders(sender_ids) + ")",
+                        list(listener_ids) + list(sender_ids))
+
+
+def _store_results(node_names, nodes, watermark, res_db):
+    """Caches the given nodes and CO measurement results.
+
+    """
+    global _watermark, _scope
+    if node_names is None:
+        _scope = None
+    else:
+        _scope = set(node_names)
+    _store_nodes(nodes)
+    _watermark = watermark
+    _store_cot_max(res_db)
+
+
+def _store_cot_max(res_db):
+    """Caches the given CO measurement results.
+
+    """
     for res in res_db:
         cot_max[node_id[res.get('id_listener')] + '-' + node_id[res.get('id_sender')]] = res.get('cot_max')
 
 
+def _get_node_ids(node_names):
+    """Returns the list of cached ids of the given nodes.
+
+    """
+    return [nid for nid, name in node_id.items() if name in node_names]
+
+
+def _get_watermark():
+    """Returns the current maximum of the WATERMARK_COLUMN, or None if the
+    database does not provide it.
+
+    """
+    try:
+        res_db = des_db.query("SELECT MAX(" + WATERMARK_COLUMN + ") AS watermark FROM \"CORResultsKernel\"",
+                              cache=False)
+    except des_db.Error:
+        return None
+    if not res_db:
+        return None
+    return res_db[0].get('watermark')
+
+
+def _placeholders(values):
+    """Returns the placeholders for an IN clause with the given values.
+
+    """
+    return ", ".join(["%s"] * len(values))
+
+
 def get_interference_by_node(node_sender, node_listener):
     """Returns if node_sender is an interferer for node_listener
     
@@ -70,12 +338,13 @@ def get_interference_by_node(node_sender, node_listener):
     
     # get node IDs
     dict_name_id = dict()
-    res_db = des_db._raw_query("SELECT id, name FROM \"Node\" WHERE name = '" + str(node_sender) + "' OR name = '" + str(node_listener) + "'")
+    res_db = des_db.query("SELECT id, name FROM \"Node\" WHERE name = %s OR name = %s",
+                          (str(node_sender), str(node_listener)))
     for res in res_db:
         dict_name_id[res.get('name')] = res.get('id')
 
-    res_db = des_db._raw_query("SELECT cot_max FROM \"CORResultsKernel\" WHERE id_sender = " \
-        + str(dict_name_id[node_sender]) + " AND id_listener = " + str(dict_name_id[node_listener]))
+    res_db = des_db.query("SELECT cot_max FROM \"CORResultsKernel\" WHERE id_sender = %s AND id_listener = %s",
+                          (dict_name_id[node_sender], dict_name_id[node_listener]))
 
     cot_m = 0
 
@@ -88,6 +357,43 @@ def get_interference_by_node(node_sender, node_listener):
         return 0
 
 
+def get_channel_interference(channel1, channel2):
+    """Returns the interference value of two links that are in conflict (see
+    get_node_conflicts(..)) and use the given channels. All channels are
+    assumed to be orthogonal.
+
+    """
+    if channel1 == channel2:
+        return 1
+    else:
+        return 0
+
+
+def get_node_conflicts(graph):
+    """Returns a dictionary that maps each node of the network graph to the set
+    of nodes it is in conflict with. Two links are in conflict, if an end node
+    of one link is in conflict with an end node of the other link. With COIM,
+    these are the nodes for which the CO measured by the node while the other
+    one was sending exceeds CO_THRESHOLD, which may include the node itself.
+
+    Note, that the conflicts are directional: like get_interference(..), only
+    the end nodes of the first link are considered as listeners, so a node is
+    mapped to the senders it senses.
+
+    """
+    nodes = graph.get_vertices()
+    if len(node_id) == 0:
+        init()
+    if _scope is not None and not _scope.issuperset(nodes):
+        extend_scope(nodes)
+    conflicts = dict([(node, set()) for node in nodes])
+    for listener in nodes:
+        for sender in nodes:
+            if cot_max.get(listener + '-' + sender, 0) > CO_THRESHOLD:
+                conflicts[listener].add(sender)
+    return conflicts
+
+
 def get_interference(graph, e1, e2):
     """Returns the interference value for the given edges according to the
     channel occupancy measurement approach. The value can either be 0 (edges 
@@ -101,6 +407,10 @@ def get_interference(graph, e1, e2):
         # syslog(LOG_DEBUG, str(datetime.now()) + "### start co caching")
         init()
         # syslog(LOG_DEBUG, str(datetime.now()) + "### end co caching")
+    # if only the results of a subset of the nodes are cached, grow the subset
+    # with the current network graph
+    if _scope is not None and not _scope.issuperset(e1 + e2):
+        extend_scope(graph.get_vertices())
 
 	# a link does not interfere with itself
     if e1 == e2:
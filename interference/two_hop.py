@@ -78,4 +78,29 @@ def get_interference(graph, e1, e2):
         return 0
 
 
+def get_channel_interference(channel1, channel2):
+    """Returns the interference value of two links that are in conflict (see
+    get_node_conflicts(..)) and use the given channels.
+
+    """
+    if channel1 == channel2:
+        return 1
+    else:
+        return 0
+
+
+def get_node_conflicts(graph):
+    """Returns a dictionary that maps each node of the network graph to the set
+    of nodes it is in conflict with. Two links are in conflict, if an end node
+    of one link is in conflict with an end node of the other link. With the
+    two-hop heuristic, these are the node itself and its direct neighbors.
+
+    """
+    conflicts = dict([(node, set([node])) for node in graph.get_vertices()])
+    for v1, v2 in graph.get_edges().keys():
+        conflicts[v1].add(v2)
+        conflicts[v2].add(v1)
+    return conflicts
+
+
 
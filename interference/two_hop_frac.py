@@ -34,6 +34,7 @@ For further information and questions please use the web site
 """
 
 from des_chan.error import CHANError
+from des_chan.interference.two_hop import get_node_conflicts
 
 frequencies = {}
 # 2.4 GHz band
@@ -78,15 +79,9 @@ def get_interference(graph, e1, e2):
         raise CHANError("Unable to calculate interference! Invalid channel %s for edge %s" % (graph.get_edges()[e2], e2))
     
     # calculate the interference level
-    diff = abs(frequencies[channel1] - frequencies[channel2])
-    # experiments showed that a channel separation of 60 MHz does not interfere
-    # on the DES-Testbed
-    # this corresponds to 3 channels in the 5GHz band and 12 channels in the
-    # 2.4GHz band
-    if diff >= MIN_FREQ_DIFF:
+    interf = get_channel_interference(channel1, channel2)
+    if interf == 0:
         return 0
-
-    interf = -1.0/MIN_FREQ_DIFF * diff + 1
     
     # distance of two edges is defined by the minimum distance of the
     # corresponding vertices
@@ -104,4 +99,19 @@ def get_interference(graph, e1, e2):
         return 0
 
 
+def get_channel_interference(channel1, channel2):
+    """Returns the interference value of two links that are in conflict (see
+    get_node_conflicts(..)) and use the given channels.
+
+    """
+    diff = abs(frequencies[channel1] - frequencies[channel2])
+    # experiments showed that a channel separation of 60 MHz does not interfere
+    # on the DES-Testbed
+    # this corresponds to 3 channels in the 5GHz band and 12 channels in the
+    # 2.4GHz band
+    if diff >= MIN_FREQ_DIFF:
+        return 0
+    return -1.0/MIN_FREQ_DIFF * diff + 1
+
+
 
@@ -0,0 +1,150 @@
+#!/usr/bin/python -t
+"""
+DES-CHAN: A Framework for Channel Assignment Algorithms for Testbeds
+
+This module caches snapshots of the local network topology retrieved from the
+ETX daemon, so algorithms can request the network graph repeatedly without
+crawling the neighborhood each time.
+
+Authors:    Matthias Philipp <mphilipp@inf.fu-berlin.de>,
+            Felix Juraschek <fjuraschek@gmail.com>
+
+Copyright 2008-2013, Freie Universitaet Berlin (FUB). All rights reserved.
+
+These sources were developed at the Freie Universitaet Berlin, 
+Computer Systems and Telematics / Distributed, embedded Systems (DES) group 
+(http://cst.mi.fu-berlin.de, http://www.des-testbed.net)
+-------------------------------------------------------------------------------
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see http://www.gnu.org/licenses/ .
+--------------------------------------------------------------------------------
+For further information and questions please use the web site
+       http://www.des-testbed.net
+       
+"""
+
+import time
+
+from twisted.internet import defer
+
+from des_chan.graph import Graph
+from des_chan.topology import etx
+
+# time (in seconds) a snapshot is considered recent
+SNAPSHOT_TTL = 5
+
+
+class TopologyCache:
+    """Returns the network graph of a recent discovery if it is not older than
+    ttl seconds, otherwise the neighborhood is discovered again. Requests that
+    arrive while a discovery is running wait for its result, so there is at
+    most one discovery at a time. The differences between successive snapshots
+    are available for the incremental update of conflict graphs.
+
+    The returned graphs are shared by all callers and must not be modified.
+    The discoveries start at the etxd of the given host.
+
+    """
+
+    def __init__(self, quality=0.6, ttl=SNAPSHOT_TTL, depth=2,
+                 deadline=etx.DEADLINE, host="localhost"):
+        self.quality = quality
+        self.ttl = ttl
+        self.depth = depth
+        self.deadline = deadline
+        self.host = host
+        # current and previous snapshot
+        self.graph = None
+        self.previous_graph = Graph()
+        self.result = None
+        self.timestamp = 0
+        # differences between the previous and the current snapshot
+        self.added = dict()
+        self.removed = dict()
+        self.changed = dict()
+        # Deferreds waiting for the running discovery, None if no discovery
+        # is running
+        self.waiting = None
+        self.listeners = list()
+
+
+    def get_network_graph(self, max_age=None):
+        """Returns a Deferred that fires with a network graph that is not older
+        than max_age seconds (by default the ttl of the cache).
+
+        """
+        if max_age is None:
+            max_age = self.ttl
+        if self.graph is not None and time.time() - self.timestamp <= max_age:
+            return defer.succeed(self.graph)
+        d = defer.Deferred()
+        if self.waiting is not None:
+            self.waiting.append(d)
+            return d
+        self.waiting = [d]
+        discovery = etx.discover(self.quality, self.depth, deadline=self.deadline,
+                                 host=self.host)
+        discovery.addCallbacks(self._discovered, self._failed)
+        return d
+
+
+    def get_diff(self):
+        """Returns the differences between the previous and the current
+        snapshot as a tuple of added, removed, and changed links, see
+        Graph.diff(..).
+
+        """
+        return self.added, self.removed, self.changed
+
+
+    def add_listener(self, listener):
+        """Adds a function that is called with the new snapshot and the
+        dictionaries of added, removed, and changed links whenever a snapshot
+        differs from its predecessor.
+
+        """
+        self.listeners.append(listener)
+
+
+    def remove_listener(self, listener):
+        """Removes the given listener.
+
+        """
+        self.listeners.remove(listener)
+
+
+    def invalidate(self):
+        """Forces a new discovery for the next request.
+
+        """
+        self.timestamp = 0
+
+
+    def _discovered(self, result):
+        if self.graph is not None:
+            self.previous_graph = self.graph
+        self.graph = result.graph
+        self.result = result
+        self.timestamp = time.time()
+        self.added, self.removed, self.changed = self.previous_graph.diff(self.graph)
+        waiting, self.waiting = self.waiting, None
+        for d in waiting:
+            d.callback(self.graph)
+        if self.added or self.removed or self.changed:
+            for listener in list(self.listeners):
+                listener(self.graph, self.added, self.removed, self.changed)
+
+
+    def _failed(self, failure):
+        waiting, self.waiting = self.waiting, None
+        for d in waiting:
+            d.errback(failure)
@@ -34,17 +34,100 @@ For further information and questions please use the web site
 """
 
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, error, threads
 from twisted.internet.protocol import ClientFactory
 from twisted.protocols.basic import LineOnlyReceiver
 
 from des_chan.graph import Graph
+from des_chan.error import CHANError
 from des_chan import util
 
 import socket
+import time
 
 TIMEOUT = 5 
 DEBUG = False
+# port of etxd
+PORT = 9157
+# maximum number of simultaneous connections of a discovery
+MAX_CONNECTIONS = 20
+# maximum duration (in seconds) of a discovery, None for no limit
+DEADLINE = 30
+# time (in seconds) resolved node names and failed lookups are cached
+NAME_TTL = 300
+NEGATIVE_NAME_TTL = 30
+# time (in seconds) between two discoveries of a subscription
+SUBSCRIPTION_INTERVAL = 10
+
+
+class NameCache:
+    """Resolves node names from IP addresses without blocking the reactor. The
+    blocking lookups of util.resolve_node_name(..) are run in the thread pool of
+    the reactor. Resolved names and failed lookups are cached, and concurrent
+    requests for the same IP address share a single lookup.
+
+    """
+
+    def __init__(self, ttl=NAME_TTL, negative_ttl=NEGATIVE_NAME_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # ip -> (expiration time, node name or None)
+        self.entries = dict()
+        # ip -> list of Deferreds waiting for the running lookup
+        self.waiting = dict()
+
+
+    def resolve(self, ip_address):
+        """Returns a Deferred that fires with the node name of the given IP
+        address, or with None if it cannot be resolved.
+
+        """
+        entry = self.entries.get(ip_address)
+        if entry is not None and entry[0] > time.time():
+            return defer.succeed(entry[1])
+        # addresses listed in the host map are resolved without a lookup
+        node_name = util.lookup_node_name(ip_address)
+        if node_name:
+            return defer.succeed(node_name)
+        d = defer.Deferred()
+        if ip_address in self.waiting:
+            self.waiting[ip_address].append(d)
+            return d
+        self.waiting[ip_address] = [d]
+        lookup = threads.deferToThread(util.resolve_node_name, ip_address)
+        lookup.addCallbacks(self._resolved, self._failed,
+                            callbackArgs=(ip_address,), errbackArgs=(ip_address,))
+        return d
+
+
+    def clear(self):
+        """Discards all cached names.
+
+        """
+        self.entries.clear()
+
+
+    def _resolved(self, node_name, ip_address):
+        self.entries[ip_address] = (time.time() + self.ttl, node_name)
+        self._fire(ip_address, node_name)
+
+
+    def _failed(self, failure, ip_address):
+        if not failure.check(CHANError):
+            print "des_chan.topology.etx: Lookup of %s failed: %s" % (ip_address,
+                                                                   failure.getErrorMessage())
+        if DEBUG: print "Unable to resolve %s: %s" % (ip_address, failure.getErrorMessage())
+        self.entries[ip_address] = (time.time() + self.negative_ttl, None)
+        self._fire(ip_address, None)
+
+
+    def _fire(self, ip_address, node_name):
+        for d in self.waiting.pop(ip_address):
+            d.callback(node_name)
+
+
+# cache shared by all discoveries
+name_cache = NameCache()
 
 
 class EtxIpcProtocol(LineOnlyReceiver):
@@ -55,98 +138,579 @@ class EtxIpcProtocol(LineOnlyReceiver):
         """Send the request for all links meeting the quality threshold.
 
         """
-        self.factory.timeout.cancel()
-        self.sendLine("CHAFT %.1f" % self.factory.quality)
+        if self.factory.timeout.active():
+            self.factory.timeout.cancel()
+        self.factory.stats.connected = time.time()
+        self.sendLine("CHAFT %.1f" % self.factory.session.quality)
+
+
+    def dataReceived(self, data):
+        self.factory.stats.bytes += len(data)
+        LineOnlyReceiver.dataReceived(self, data)
 
     
     def lineReceived(self, line):
         """Receive and parse the result for the local network topology.
-        If recursive is set, send requests to our neighbors which eventually will 
-        deliver the 2-hop neighborhood.
+        If the crawl depth is not reached yet, send requests to our neighbors
+        which eventually will deliver the multi-hop neighborhood.
 
         """
-        # split line in vertex names
-        neighbor_ip, channel = line.split(":")
-        channel = int(channel)
+        if self.factory.session.done:
+            return
+        stats = self.factory.stats
+        stats.lines += 1
+        if stats.first_line is None:
+            stats.first_line = time.time()
+        # split line in vertex names, the channel, and the ETX value of the
+        # link, if it is reported by etxd
+        fields = line.split(":")
+        neighbor_ip = fields[0]
+        channel = int(fields[1])
+        if len(fields) > 2:
+            etx_value = float(fields[2])
+        else:
+            etx_value = None
         # try to resolve the name of the corresponding nodes
-        node1 = util.resolve_node_name(self.factory.host)
-        node2 = util.resolve_node_name(neighbor_ip)
+        d = defer.gatherResults([name_cache.resolve(self.factory.host),
+                                 name_cache.resolve(neighbor_ip)])
+        d.addCallback(self.factory.session.stats.resolved, time.time())
+        d.addCallback(self._add_link, neighbor_ip, channel, etx_value)
+        self.factory.session.track(d, self.factory.host)
+
+
+    def _add_link(self, node_names, neighbor_ip, channel, etx_value=None):
+        """Adds the link between the resolved nodes to the graph and queries the
+        neighbor, if it has not been queried yet with at least the remaining
+        depth.
+
+        """
+        node1, node2 = node_names
+        session = self.factory.session
+        # the graph has already been delivered
+        if session.done:
+            return
+        if self.factory.depth > 1:
+            # a neighbor is queried only once, although it is reported for
+            # each channel it shares with us, unless it is reached again on a
+            # shorter path, which leaves more hops to crawl from it
+            host = node1 or self.factory.host
+            session.visited[host] = max(session.visited.get(host, 0),
+                                        self.factory.depth)
+            neighbor = node2 or neighbor_ip
+            depth = self.factory.depth - 1
+            if session.visited.get(neighbor, 0) < depth:
+                session.visited[neighbor] = depth
+                reactor.callWhenRunning(session.query_host, neighbor_ip, depth)
         if not node1 or not node2:
             return
-        # add vertices to graph
-        self.factory.graph.add_vertex(node1)
-        self.factory.graph.add_vertex(node2)
-        # set channel as edge value
-        edge_value = self.factory.graph.get_edge_value((node1, node2))
-        if not edge_value:
-            edge_value = set()
-        edge_value.add(channel)
-        self.factory.graph.set_edge_value((node1, node2), edge_value)
-        if self.factory.recursive:
-            # get two-hop neighbors and stop recursion
-            reactor.callWhenRunning(_query_host, neighbor_ip,
-                                    self.factory.graph, self.factory.deferred)
+        start_time = time.time()
+        session.add_link(node1, node2, channel, etx_value)
+        session.stats.graph_time += time.time() - start_time
         
 
 class EtxIpcFactory(ClientFactory):
 
-    conn_cnt = 0
-
-    def __init__(self, host, graph, deferred, recursive,quality):
+    def __init__(self, host, session, depth):
         self.protocol = EtxIpcProtocol
         self.host = host
-        self.graph = graph
-        self.deferred = deferred
-        self.recursive = recursive
-        self.quality=quality
+        self.session = session
+        # remaining number of hops to crawl, 1 means only the links of this
+        # host are requested
+        self.depth = depth
+        # fires when the connection is closed
+        self.closed = defer.Deferred()
+        self.connector = None
+        # pending call of _timed_out(..)
+        self.timeout = None
+        self.stats = session.stats.get_host_stats(host)
 
     def startedConnecting(self, connector):
+        self.stats.connecting = time.time()
         if DEBUG: print "Connecting to %s" % (connector.getDestination().host)
-        EtxIpcFactory.conn_cnt += 1
-        if DEBUG: print "num connections %d" % EtxIpcFactory.conn_cnt
+        if DEBUG: print "pending %d" % self.session.pending
 
     def clientConnectionFailed(self, connector, reason):
         print "des_chan.topology.etx: Connection to %s failed: %s" % (connector.getDestination().host,
                                                reason.getErrorMessage())
-        self.finished()
+        self.stats.error = reason.getErrorMessage()
+        self.connection_closed()
     
     def clientConnectionLost(self, connector, reason):
         if DEBUG: print "Connection to %s lost" % (connector.getDestination().host)
-        self.finished()
+        # etxd closes the connection after the reply has been sent
+        if reason.check(error.ConnectionDone):
+            self.session.answered.add(self.host)
+        else:
+            self.stats.error = reason.getErrorMessage()
+        self.connection_closed()
     
-    def finished(self):
-        EtxIpcFactory.conn_cnt -= 1
-        if DEBUG: print "num connections %d" % EtxIpcFactory.conn_cnt
+    def connection_closed(self):
+        if self.timeout is not None and self.timeout.active():
+            self.timeout.cancel()
+        self.stats.closed = time.time()
+        self.session.connectors.discard(self.connector)
+        self.closed.callback(None)
+        self.session.work_done()
+
+
+class HostStats:
+    """Timing and traffic of the query of a single etxd. All times are given
+    as absolute time stamps (time.time()), None if the event did not occur.
+
+    """
+
+    def __init__(self, host):
+        self.host = host
+        # the query has been scheduled, but may wait for a free connection
+        self.queued = time.time()
+        self.connecting = None
+        self.connected = None
+        self.first_line = None
+        self.closed = None
+        self.lines = 0
+        self.bytes = 0
+        self.timed_out = False
+        # error message of a failed or lost connection
+        self.error = None
+
+
+    def get_connect_latency(self):
+        """Returns the time needed to establish the connection.
+
+        """
+        if self.connecting is None or self.connected is None:
+            return None
+        return self.connected - self.connecting
+
+
+    def get_response_latency(self):
+        """Returns the time between the request and the end of the reply.
+
+        """
+        if self.connected is None or self.closed is None:
+            return None
+        return self.closed - self.connected
+
+
+    def as_dict(self):
+        """Returns the statistics as dictionary, e.g. for the export to a
+        monitoring system.
+
+        """
+        return {"host": self.host,
+                "queue_time": _diff(self.queued, self.connecting),
+                "connect_latency": self.get_connect_latency(),
+                "first_line_latency": _diff(self.connected, self.first_line),
+                "response_latency": self.get_response_latency(),
+                "lines": self.lines,
+                "bytes": self.bytes,
+                "timed_out": self.timed_out,
+                "error": self.error}
+
+
+class DiscoveryStats:
+    """Statistics of a discovery session: the statistics of each queried host,
+    the time spent waiting for name lookups, and the time spent updating the
+    graph.
+
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        # host -> HostStats
+        self.hosts = dict()
+        # number of name lookups and the accumulated time until they finished
+        self.lookups = 0
+        self.resolution_time = 0.0
+        # accumulated time spent recording links and building the graph
+        self.graph_time = 0.0
+
+
+    def get_host_stats(self, host):
+        """Returns the HostStats of the given host.
+
+        """
+        if host not in self.hosts:
+            self.hosts[host] = HostStats(host)
+        return self.hosts[host]
+
+
+    def resolved(self, node_names, start_time):
+        """Callback for finished name lookups, records the lookup time.
+
+        """
+        self.lookups += len(node_names)
+        self.resolution_time += time.time() - start_time
+        return node_names
+
+
+    def as_dict(self):
+        """Returns the statistics as dictionary, e.g. for the export to a
+        monitoring system.
+
+        """
+        hosts = [stats.as_dict() for host, stats in sorted(self.hosts.items())]
+        return {"duration": _diff(self.start_time, self.end_time),
+                "hosts": hosts,
+                "queried": len(hosts),
+                "failed": len([h for h in hosts if h["error"] is not None]),
+                "timed_out": len([h for h in hosts if h["timed_out"]]),
+                "lines": sum([h["lines"] for h in hosts]),
+                "bytes": sum([h["bytes"] for h in hosts]),
+                "lookups": self.lookups,
+                "resolution_time": self.resolution_time,
+                "graph_time": self.graph_time}
+
+
+class DiscoveryResult:
+    """Result of a discovery: the network graph, the addresses of the hosts
+    that did not answer (in time), whether the discovery completed before
+    the deadline, and the DiscoveryStats.
+
+    """
+
+    def __init__(self, graph, unanswered, complete, stats=None):
+        self.graph = graph
+        self.unanswered = unanswered
+        self.complete = complete
+        self.stats = stats
+
+
+class DiscoverySession:
+    """Discovery of the neighborhood up to the given number of hops. Each
+    session has its own state, so several discoveries may run at the same time.
+    Each node is queried only once, and at most max_connections nodes are
+    queried at the same time. If the discovery takes longer than deadline
+    seconds, it is stopped and the neighborhood discovered so far is
+    delivered. If a stats_callback is given, it is called with the
+    DiscoveryStats when the discovery has finished.
+
+    """
+
+    def __init__(self, quality=0.6, depth=2, max_connections=MAX_CONNECTIONS,
+                 deadline=DEADLINE, host="localhost", stats_callback=None):
+        self.quality = quality
+        self.stats = DiscoveryStats()
+        self.stats_callback = stats_callback
+        # the etxd that is queried first
+        self.host = host
+        self.depth = depth
+        self.deadline = deadline
+        # discovered nodes and links, the graph is built once when the
+        # discovery has finished
+        self.vertices = set()
+        # (node1, node2) -> set of channels
+        self.links = dict()
+        # (node1, node2) -> ETX value
+        self.weights = dict()
+        self.deferred = defer.Deferred()
+        # number of queries and name lookups that have not finished yet
+        self.pending = 0
+        # names of the nodes that have been queried (or their addresses, if
+        # the names cannot be resolved) -> largest remaining depth they have
+        # been queried with
+        self.visited = dict()
+        # addresses of the queried hosts and of those that answered
+        self.queried = set()
+        self.answered = set()
+        # connectors of the open connections
+        self.connectors = set()
+        # limits the number of simultaneous connections
+        self.semaphore = defer.DeferredSemaphore(max_connections)
+        self.deadline_call = None
+        self.done = False
+
+
+    def start(self):
+        """Starts the discovery. Returns a Deferred that fires with the
+        DiscoveryResult.
+
+        """
+        if self.deadline is not None:
+            self.deadline_call = reactor.callLater(self.deadline, self._deadline_passed)
+        # at first get the one-hop neighbors of this node, afterwards recursively
+        # get the multi-hop neighbors by querying the neighbors
+        reactor.callWhenRunning(self.query_host, self.host, self.depth)
+        return self.deferred
+
+
+    def query_host(self, host, depth=1):
+        """Query one of our neighbors for its neighbors, so we can determine our
+        multi-hop neighborhood. The query waits until less than the maximum
+        number of connections are open.
+
+        """
+        if self.done:
+            return
+        # the discovery is not complete until this host has been queried
+        self.pending += 1
+        self.queried.add(host)
+        self.semaphore.run(self._connect, host, depth)
+
+
+    def add_link(self, node1, node2, channel, etx_value=None):
+        """Records the link between the two nodes on the given channel. If the
+        ETX value of the link is given, the best ETX value of all channels is
+        used as weight of the link.
+
+        """
+        self.vertices.add(node1)
+        self.vertices.add(node2)
+        # the graph is undirected
+        if node2 < node1:
+            node1, node2 = node2, node1
+        self.links.setdefault((node1, node2), set()).add(channel)
+        if etx_value is not None:
+            self.weights[(node1, node2)] = min(etx_value,
+                                               self.weights.get((node1, node2), etx_value))
+
+
+    def get_graph(self):
+        """Returns a new Graph containing the nodes and links discovered so
+        far. The channels of each link are stored as set in the edge value, the
+        ETX values as edge weights.
+
+        """
+        graph = Graph(list(self.vertices))
+        for edge, channels in self.links.items():
+            graph.set_edge_value(edge, set(channels), False)
+        for edge, weight in self.weights.items():
+            graph.set_edge_weight(edge, weight)
+        # calculate the distances once for all links
+        graph.update_distances()
+        return graph
+
+
+    def track(self, deferred, host):
+        """Delays the completion of the discovery until the given Deferred,
+        e.g. of a name lookup, has fired.
+
+        """
+        self.pending += 1
+        deferred.addErrback(self._track_failed, host)
+        deferred.addBoth(lambda _: self.work_done())
+
+
+    def work_done(self):
+        """Called when a query or name lookup has finished.
+
+        """
+        self.pending -= 1
+        if DEBUG: print "pending %d" % self.pending
         # if all connections have been closed, i.e. all neighbors have been
         # queried for their neighbors
-        if EtxIpcFactory.conn_cnt == 0:
-            # fire the callback
-            self.deferred.callback(self.graph)
+        if self.pending == 0:
+            self._finish(True)
 
 
-def _timed_out(port):
+    def _connect(self, host, depth):
+        """Opens the connection to the etxd of the given host. Returns a
+        Deferred that fires when the connection is closed.
+
+        """
+        if self.done:
+            self.work_done()
+            return None
+        ipc_factory = EtxIpcFactory(host, self, depth)
+        port = reactor.connectTCP(host, PORT, ipc_factory)
+        ipc_factory.connector = port
+        self.connectors.add(port)
+        # schedule timeout function that stops the connection if it takes too long
+        ipc_factory.timeout = reactor.callLater(TIMEOUT, _timed_out, port,
+                                                ipc_factory.stats)
+        return ipc_factory.closed
+
+
+    def _track_failed(self, failure, host):
+        print "des_chan.topology.etx: Unable to process reply of %s: %s" % (host,
+                                                                         failure.getErrorMessage())
+
+
+    def _deadline_passed(self):
+        self.deadline_call = None
+        if DEBUG: print "deadline passed"
+        self._finish(False)
+
+
+    def _finish(self, complete):
+        """Delivers the result and stops all remaining connections.
+
+        """
+        if self.done:
+            return
+        self.done = True
+        if self.deadline_call is not None:
+            self.deadline_call.cancel()
+            self.deadline_call = None
+        start_time = time.time()
+        graph = self.get_graph()
+        self.stats.graph_time += time.time() - start_time
+        self.stats.end_time = time.time()
+        result = DiscoveryResult(graph, sorted(self.queried - self.answered),
+                                 complete, self.stats)
+        for connector in list(self.connectors):
+            connector.disconnect()
+        if self.stats_callback is not None:
+            try:
+                self.stats_callback(self.stats)
+            except Exception, e:
+                print "des_chan.topology.etx: Stats callback failed: %s" % e
+        self.deferred.callback(result)
+
+
+def _timed_out(port, stats=None):
     if DEBUG: print "connection timed out"
+    if stats is not None:
+        stats.timed_out = True
     port.disconnect()
 
 
-def _query_host(host, graph, deferred, recursive=False,quality=0.6):
-    """Query one of our neighbors for its neighbors, so we can determine our 2-hop neighborhood.
+def _diff(start, end):
+    """Returns the time between start and end, or None if one is unknown.
+
+    """
+    if start is None or end is None:
+        return None
+    return end - start
+
+
+def discover(quality=0.6, depth=2, max_connections=MAX_CONNECTIONS,
+             deadline=DEADLINE, host="localhost", stats_callback=None):
+    """Starts a DiscoverySession and returns a Deferred that fires with the
+    DiscoveryResult. By default, the neighborhood of this node is discovered,
+    another host may be given to start the discovery at its etxd.
+
+    """
+    return DiscoverySession(quality, depth, max_connections, deadline,
+                            host, stats_callback).start()
+
+
+def get_network_graph(quality=0.6, depth=2, max_connections=MAX_CONNECTIONS,
+                      deadline=DEADLINE, host="localhost", stats_callback=None):
+    """Retrieve the neighborhood up to the given number of hops, by default the
+    2-hop neighborhood. Each node is queried only once, and at most
+    max_connections nodes are queried at the same time. If the discovery takes
+    longer than deadline seconds, the neighborhood discovered so far is
+    returned. The discovery starts at the etxd of the given host. The
+    stats_callback is called with the DiscoveryStats.
 
     """
-    ipc_factory = EtxIpcFactory(host, graph, deferred, recursive, quality)
-    port = reactor.connectTCP(host, 9157, ipc_factory)
-    # schedule timeout function that stops the connection if it takes too long
-    ipc_factory.timeout = reactor.callLater(TIMEOUT, _timed_out, port)
+    d = discover(quality, depth, max_connections, deadline, host,
+                 stats_callback)
+    d.addCallback(lambda result: result.graph)
+    return d
+
 
 
-def get_network_graph(quality=0.6):
-    """Retrieve the 2-hop neighborhood.
+class EtxSubscription:
+    """Keeps a network graph up to date for continuous channel adaptation.
+    The neighborhood is discovered every interval seconds, and only the
+    differences to the previous discovery are applied to the graph, which
+    persists for the lifetime of the subscription. Listeners are notified about
+    every change. The discoveries start at the etxd of the given host.
 
     """
-    deferred = defer.Deferred()
-    graph = Graph()
-    # at first get the one-hop neighbors of this node, afterwards recursively
-    # get the two-hop neighbors by querying the one-hop neighbors
-    reactor.callWhenRunning(_query_host, "localhost", graph, deferred, True, quality)
-    return deferred
 
+    def __init__(self, quality=0.6, interval=SUBSCRIPTION_INTERVAL,
+                 host="localhost"):
+        self.quality = quality
+        self.interval = interval
+        self.host = host
+        self.graph = Graph()
+        self.listeners = list()
+        self.call = None
+        self.running = False
+
+
+    def add_listener(self, listener):
+        """Adds a function that is called with the graph and the dictionaries
+        of added, removed, and changed links (see Graph.diff(..)) whenever the
+        network graph has changed.
+
+        """
+        self.listeners.append(listener)
+
+
+    def remove_listener(self, listener):
+        """Removes the given listener.
+
+        """
+        self.listeners.remove(listener)
+
+
+    def start(self):
+        """Starts the periodic discovery.
+
+        """
+        if self.running:
+            return
+        self.running = True
+        reactor.callWhenRunning(self._discover)
+
+
+    def stop(self):
+        """Stops the periodic discovery.
+
+        """
+        self.running = False
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+
+    def _discover(self):
+        self.call = None
+        if not self.running:
+            return
+        d = get_network_graph(self.quality, host=self.host)
+        d.addCallback(self._update)
+        d.addErrback(self._failed)
+        d.addBoth(self._schedule)
+
+
+    def _schedule(self, _):
+        if self.running:
+            self.call = reactor.callLater(self.interval, self._discover)
+
+
+    def _failed(self, failure):
+        print "des_chan.topology.etx: Discovery failed: %s" % failure.getErrorMessage()
+
+
+    def _update(self, graph):
+        """Applies the differences between the persistent graph and the given
+        graph to the persistent graph and notifies the listeners.
+
+        """
+        added, removed, changed = self.graph.diff(graph)
+        obsolete_vertices = self.graph.get_vertices() - graph.get_vertices()
+        # link weights do not count as changes of the topology
+        self.graph.copy_weights(graph)
+        if not added and not removed and not changed and not obsolete_vertices:
+            return
+        for vertex in graph.get_vertices() - self.graph.get_vertices():
+            self.graph.add_vertex(vertex)
+        for edge in removed.keys():
+            self.graph.set_edge_value(edge, None, False)
+        for edge, value in added.items() + changed.items():
+            self.graph.set_edge_value(edge, value, False)
+        for vertex in obsolete_vertices:
+            self.graph.remove_vertex(vertex)
+        # removed links may increase distances
+        self.graph.update_distances(reset=bool(removed or obsolete_vertices))
+        for listener in list(self.listeners):
+            listener(self.graph, added, removed, changed)
+
+
+def subscribe(listener, quality=0.6, interval=SUBSCRIPTION_INTERVAL,
+              host="localhost"):
+    """Starts a subscription to the network graph and returns the
+    EtxSubscription object. The listener is called for every change of the
+    network graph.
+
+    """
+    subscription = EtxSubscription(quality, interval, host)
+    subscription.add_listener(listener)
+    subscription.start()
+    return subscription
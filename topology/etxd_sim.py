@@ -0,0 +1,362 @@
+#!/usr/bin/python -t
+"""
+DES-CHAN: A Framework for Channel Assignment Algorithms for Testbeds
+
+This module simulates the ETX daemons of a network, so the topology discovery
+of des_chan.topology.etx can be run and benchmarked without a testbed. Each
+interface of a virtual node gets its own loopback address (127.0.0.0/8 is
+routed to the loopback interface on Linux, so no configuration is required),
+and an etxd stand-in listening on that address answers CHAFT requests with the
+links of the virtual node. The topology is either generated or loaded from a
+recorded graph, e.g. a graphviz dot file written by Graph.write_to_file(..).
+
+Note, that every interface needs a listening socket, so the limit of open
+files (ulimit -n) has to be raised for large networks.
+
+Usage example (serve 500 nodes and measure 5 discoveries from one of them):
+
+    python etxd_sim.py --nodes 500 --degree 8 --runs 5
+
+Authors:    Matthias Philipp <mphilipp@inf.fu-berlin.de>,
+            Felix Juraschek <fjuraschek@gmail.com>
+
+Copyright 2008-2013, Freie Universitaet Berlin (FUB). All rights reserved.
+
+These sources were developed at the Freie Universitaet Berlin,
+Computer Systems and Telematics / Distributed, embedded Systems (DES) group
+(http://cst.mi.fu-berlin.de, http://www.des-testbed.net)
+-------------------------------------------------------------------------------
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see http://www.gnu.org/licenses/ .
+--------------------------------------------------------------------------------
+For further information and questions please use the web site
+       http://www.des-testbed.net
+
+"""
+
+import math
+import os
+import random
+import re
+import socket
+import struct
+import time
+
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineOnlyReceiver
+
+from des_chan.graph import Graph
+from des_chan import util
+from des_chan.topology import etx
+
+# default channels of the three radios of a node
+CHANNELS = (14, 36, 40)
+# first loopback address assigned to a virtual interface
+BASE_ADDRESS = "127.1.0.1"
+
+
+class EtxdSimProtocol(LineOnlyReceiver):
+
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.call = None
+
+
+    def lineReceived(self, line):
+        """Answers a CHAFT request with the links of the node after the
+        configured delay, or drops the connection to simulate a failure.
+
+        """
+        fields = line.split()
+        if len(fields) != 2 or fields[0] != "CHAFT":
+            self.transport.loseConnection()
+            return
+        sim = self.factory.sim
+        sim.queries += 1
+        if sim.random.random() < sim.failure_rate:
+            sim.failures += 1
+            self.transport.abortConnection()
+            return
+        self.call = reactor.callLater(sim.get_delay(), self._reply,
+                                      float(fields[1]))
+
+
+    def connectionLost(self, reason):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+
+
+    def _reply(self, quality):
+        self.call = None
+        for line in self.factory.sim.get_reply(self.factory.node, quality):
+            self.sendLine(line)
+        self.transport.loseConnection()
+
+
+class EtxdSimFactory(ServerFactory):
+
+    protocol = EtxdSimProtocol
+
+    def __init__(self, sim, node):
+        self.sim = sim
+        self.node = node
+
+
+class EtxdSimulator:
+    """Serves the CHAFT protocol of etxd for all nodes of the given graph. The
+    edge values hold the channels of the links (a single channel or a
+    collection of channels), the edge weights their ETX values. Links whose
+    delivery ratio 1/ETX is below the requested quality are not reported.
+
+    Responses are delayed by delay seconds, or by a random time between the
+    two values if a tuple is given. A query fails with probability
+    failure_rate, and the nodes in unresponsive do not accept connections.
+
+    """
+
+    def __init__(self, graph, delay=0, failure_rate=0.0, unresponsive=(),
+                 report_etx=False, seed=None):
+        self.graph = graph
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.unresponsive = set(unresponsive)
+        # append the ETX value to each reported link
+        self.report_etx = report_etx
+        self.random = random.Random(seed)
+        # (node, channel) -> IP address of the interface
+        self.addresses = dict()
+        self.ports = list()
+        # statistics
+        self.queries = 0
+        self.failures = 0
+        # node -> list of (neighbor, channels, ETX value)
+        self.links = dict([(node, list()) for node in graph.get_vertices()])
+        for (v1, v2), value in graph.get_edges().items():
+            channels = _get_link_channels(value)
+            etx_value = graph.get_edge_weight((v1, v2))
+            self.links[v1].append((v2, channels, etx_value))
+            self.links[v2].append((v1, channels, etx_value))
+        next_address = struct.unpack("!I", socket.inet_aton(BASE_ADDRESS))[0]
+        for node in sorted(graph.get_vertices()):
+            for channel in sorted(self.get_channels(node)):
+                self.addresses[(node, channel)] = socket.inet_ntoa(struct.pack("!I", next_address))
+                next_address += 1
+
+
+    def get_channels(self, node):
+        """Returns the set of channels the given node has links on.
+
+        """
+        channels = set()
+        for neighbor, link_channels, etx_value in self.links[node]:
+            channels |= link_channels
+        return channels
+
+
+    def get_address(self, node, channel=None):
+        """Returns the address of the interface of the node on the given
+        channel, or of any interface if no channel is given.
+
+        """
+        if channel is None:
+            channel = min(self.get_channels(node))
+        return self.addresses[(node, channel)]
+
+
+    def get_host_map(self):
+        """Returns a util.HostMap for the virtual interfaces.
+
+        """
+        mapping = dict()
+        for (node, channel), address in self.addresses.items():
+            mapping["%s-ch%d" % (node, channel)] = address
+        return util.HostMap(mapping=mapping)
+
+
+    def write_hosts_file(self, file_name):
+        """Writes the virtual interfaces in the format of /etc/hosts, so they can
+        be resolved by another process through util.HostMap(file_name).
+
+        """
+        file = open(file_name, 'w')
+        for (node, channel), address in sorted(self.addresses.items()):
+            file.write("%s\t%s-ch%d\n" % (address, node, channel))
+        file.close()
+
+
+    def get_delay(self):
+        """Returns the response delay of a query.
+
+        """
+        if isinstance(self.delay, tuple):
+            return self.random.uniform(*self.delay)
+        return self.delay
+
+
+    def get_reply(self, node, quality):
+        """Returns the lines etxd would send for the given node and quality
+        threshold.
+
+        """
+        lines = list()
+        for neighbor, channels, etx_value in self.links[node]:
+            if 1.0 / etx_value < quality:
+                continue
+            for channel in sorted(channels):
+                line = "%s:%d" % (self.addresses[(neighbor, channel)], channel)
+                if self.report_etx:
+                    line += ":%.2f" % etx_value
+                lines.append(line)
+        return lines
+
+
+    def start(self):
+        """Starts listening on the addresses of all responsive nodes.
+
+        """
+        for (node, channel), address in self.addresses.items():
+            if node in self.unresponsive:
+                continue
+            self.ports.append(reactor.listenTCP(etx.PORT, EtxdSimFactory(self, node),
+                                                interface=address))
+
+
+    def stop(self):
+        """Stops listening. Returns a Deferred that fires when all ports are
+        closed.
+
+        """
+        ports, self.ports = self.ports, list()
+        return defer.DeferredList([defer.maybeDeferred(port.stopListening)
+                                   for port in ports])
+
+
+def _get_link_channels(value):
+    """Returns the set of channels of the given edge value.
+
+    """
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return set([int(channel) for channel in value])
+    try:
+        return set([int(value)])
+    except (TypeError, ValueError):
+        # values read from a dot file, e.g. "set([36, 40])"
+        return set([int(channel) for channel in re.findall(r"\d+", str(value))])
+
+
+def random_topology(num_nodes, degree=8, channels=CHANNELS, max_etx=3.0,
+                    prefix="sim-", seed=None):
+    """Returns a random geometric graph with num_nodes nodes placed in the unit
+    square. Nodes are connected if they are closer than the radius that yields
+    the given average degree. Each link exists on all given channels and gets a
+    random ETX value between 1 and max_etx as weight.
+
+    """
+    rand = random.Random(seed)
+    names = ["%s%04d" % (prefix, i) for i in range(num_nodes)]
+    positions = dict([(name, (rand.random(), rand.random())) for name in names])
+    radius = math.sqrt(float(degree) / (math.pi * num_nodes))
+    graph = Graph(names)
+    # sort by x coordinate, so only nearby nodes have to be compared
+    ordered = sorted(names, key=lambda name: positions[name][0])
+    for i, v1 in enumerate(ordered):
+        x1, y1 = positions[v1]
+        for v2 in ordered[i + 1:]:
+            x2, y2 = positions[v2]
+            if x2 - x1 > radius:
+                break
+            if (x2 - x1) ** 2 + (y2 - y1) ** 2 < radius ** 2:
+                graph.set_edge_value((v1, v2), set(channels), False)
+                graph.set_edge_weight((v1, v2), rand.uniform(1.0, max_etx))
+    return graph
+
+
+def load_topology(file_name):
+    """Returns the recorded topology stored in the given graphviz dot file.
+
+    """
+    graph = Graph()
+    graph.read_from_dotfile(file_name)
+    return graph
+
+
+def measure_discovery(sim, node, **kwargs):
+    """Runs a discovery starting at the given virtual node. Returns a Deferred
+    that fires with a dictionary holding the latency and the CPU time of the
+    discovery, the number of discovered nodes and links, and the totals of
+    the DiscoveryStats. Note, that the CPU time includes the simulated etxds,
+    if they run in the same process. Further keyword arguments are passed to
+    etx.discover(..).
+
+    """
+    etx.name_cache.clear()
+    start_time = time.time()
+    start_cpu = sum(os.times()[:2])
+    d = etx.discover(host=sim.get_address(node), **kwargs)
+    def finished(result):
+        stats = result.stats.as_dict()
+        del stats["hosts"]
+        stats.update({"latency": time.time() - start_time,
+                      "cpu": sum(os.times()[:2]) - start_cpu,
+                      "nodes": len(result.graph.get_vertices()),
+                      "links": len(result.graph.get_edges()),
+                      "unanswered": len(result.unanswered),
+                      "complete": result.complete})
+        return stats
+    d.addCallback(finished)
+    return d
+
+
+# this only runs if the module was *not* imported
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulates etxd for a virtual network.")
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--degree", type=float, default=8)
+    parser.add_argument("--dotfile", help="replay the recorded topology of a dot file")
+    parser.add_argument("--delay", type=float, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--quality", type=float, default=0.6)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--serve", action="store_true",
+                        help="only serve the topology, do not run discoveries")
+    parser.add_argument("--hosts-file", help="write the virtual interfaces to this file")
+    args = parser.parse_args()
+
+    if args.dotfile:
+        topology = load_topology(args.dotfile)
+    else:
+        topology = random_topology(args.nodes, args.degree, seed=args.seed)
+    sim = EtxdSimulator(topology, delay=args.delay, failure_rate=args.failure_rate,
+                        seed=args.seed)
+    util.set_host_map(sim.get_host_map())
+    if args.hosts_file:
+        sim.write_hosts_file(args.hosts_file)
+    sim.start()
+
+    @defer.inlineCallbacks
+    def run():
+        # start at the node with the most neighbors
+        node = max(topology.get_vertices(), key=lambda v: len(sim.links[v]))
+        for i in range(args.runs):
+            stats = yield measure_discovery(sim, node, quality=args.quality,
+                                            depth=args.depth)
+            print " ".join(["%s=%s" % item for item in sorted(stats.items())])
+        reactor.stop()
+
+    if not args.serve:
+        reactor.callWhenRunning(run)
+    reactor.run()
@@ -34,22 +34,186 @@ For further information and questions please use the web site
        
 """
 
+import os
+import re
 import sys
+import math
 import time
+import select
+import fcntl
 import socket
+import struct
 import subprocess
+import threading
+from collections import deque
 
-import netifaces
 from pythonwifi import iwlibs
 
 from des_chan.error import *
 
-def resolve_node_name(ip_address):
-    """Resolves the name of the node to which the given IP address belongs.
+# file that lists the names and IP addresses of the interfaces of all nodes
+HOSTS_FILE = "/etc/hosts"
+# minimum time (in seconds) between two checks for changes of the hosts file
+HOSTS_CHECK_INTERVAL = 1.0
+# directory that lists the network interfaces and their state
+SYSFS_NET = "/sys/class/net"
+# maximum age (in seconds) of the cached interface states
+INTERFACE_STATE_TTL = 1.0
+# time (in seconds) after which the channel index is checked against the radios
+CHANNEL_INDEX_CHECK_INTERVAL = 10.0
+# command and default parameters used to check if hosts are reachable
+PING_COMMAND = "ping"
+PING_COUNT = 5
+PING_TIMEOUT = 5.0
+
+
+class HostMap:
+    """Index of the interface names and IP addresses of the testbed nodes. The
+    interface names follow the convention <node>-ch<channel>. The index is
+    built from a hosts file, which is reloaded when it changes, or from a
+    given mapping of host names to IP addresses.
+
+    """
+
+    def __init__(self, file_name=HOSTS_FILE, mapping=None):
+        self.file_name = file_name
+        self.mtime = None
+        self.last_check = 0
+        # (node name, channel) -> IP address
+        self.ips = dict()
+        # IP address -> node name
+        self.node_names = dict()
+        if mapping is not None:
+            # the index is static
+            self.file_name = None
+            self._build(mapping.items())
+        else:
+            self.reload()
+
+
+    def reload(self):
+        """Rebuilds the index from the hosts file, if it has been modified.
+
+        """
+        self.last_check = time.time()
+        try:
+            mtime = os.stat(self.file_name).st_mtime
+        except OSError:
+            # no hosts file, no entries
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        entries = list()
+        if mtime is not None:
+            file = open(self.file_name, 'r')
+            for line in file:
+                # discard comments
+                fields = line.split("#")[0].split()
+                if len(fields) < 2:
+                    continue
+                # the first name is the canonical host name
+                for host_name in fields[1:]:
+                    entries.append((host_name, fields[0]))
+            file.close()
+        self._build(entries)
+
+
+    def get_ip(self, node_name, channel):
+        """Returns the IP address of the interface of the given node that is
+        tuned to the given channel, or None if it is unknown.
+
+        """
+        self._check()
+        try:
+            channel = int(channel)
+        except (TypeError, ValueError):
+            return None
+        return self.ips.get((node_name, channel))
+
+
+    def get_node_name(self, ip_address):
+        """Returns the name of the node to which the given IP address belongs,
+        or None if it is unknown.
+
+        """
+        self._check()
+        return self.node_names.get(ip_address)
+
+
+    def _check(self):
+        """Reloads the hosts file if it may have changed.
+
+        """
+        if self.file_name is not None and \
+           time.time() - self.last_check > HOSTS_CHECK_INTERVAL:
+            self.reload()
+
+
+    def _build(self, entries):
+        """Builds the index from the given (host name, IP address) tuples.
+
+        """
+        ips = dict()
+        node_names = dict()
+        for host_name, ip in entries:
+            # the domain of fully qualified names is ignored
+            match = re.match(r"^([^.]+)-ch(\d+)(\..*)?$", host_name)
+            if match:
+                ips[(match.group(1), int(match.group(2)))] = ip
+            # same rule as resolve_node_name(..) for names of the resolver,
+            # so e.g. t9-035-ch36.des-testbed.net maps to t9-035
+            node_name = host_name.split("-ch")[0]
+            # the first entry of an IP address is the canonical one
+            if ip not in node_names:
+                node_names[ip] = node_name
+        self.ips = ips
+        self.node_names = node_names
+
+
+# Global variable to store the HostMap object
+_host_map = None
+
+
+def get_host_map():
+    """Returns the index of interface names and IP addresses, which is built
+    from HOSTS_FILE on the first call.
+
+    """
+    global _host_map
+    if _host_map is None:
+        _host_map = HostMap()
+    return _host_map
+
+
+def set_host_map(host_map):
+    """Sets the index of interface names and IP addresses used by
+    resolve_node_name(..) and get_node_ip(..), e.g. HostMap(mapping={...}).
+
+    """
+    global _host_map
+    _host_map = host_map
+
+
+def lookup_node_name(ip_address):
+    """Returns the name of the node to which the given IP address belongs, if
+    it can be determined without querying the system resolver, otherwise None.
 
     """
     if ip_address == "localhost" or ip_address == "127.0.0.1":
         return socket.gethostname()
+    return get_host_map().get_node_name(ip_address)
+
+
+def resolve_node_name(ip_address):
+    """Resolves the name of the node to which the given IP address belongs.
+    The host map is consulted first, the system resolver is only queried for
+    unknown addresses.
+
+    """
+    node_name = lookup_node_name(ip_address)
+    if node_name:
+        return node_name
     try:
         host_name = socket.gethostbyaddr(ip_address)[0]
     except socket.herror:
@@ -66,6 +230,9 @@ def get_node_ip(node_name, channel):
     given node and is tuned to the given channel.
 
     """
+    ip = get_host_map().get_ip(node_name, channel)
+    if ip:
+        return ip
     host_name = "%s-ch%s" % (node_name, channel)
     try:
         ip = socket.gethostbyname(host_name)
@@ -75,37 +242,368 @@ def get_node_ip(node_name, channel):
         return ip
 
 
+class ProbeResult:
+    """Result of the reachability check of a single host.
+
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.reachable = False
+        # round trip times (in milliseconds) of the received replies
+        self.rtts = list()
+        # reason why the host is not reachable, if known
+        self.error = None
+        # time (in seconds) until the first reply was received
+        self.latency = None
+
+
+    def get_rtt(self):
+        """Returns the minimum round trip time, or None if the host did not
+        reply.
+
+        """
+        if not self.rtts:
+            return None
+        return min(self.rtts)
+
+
+def probe_hosts(hosts, count=PING_COUNT, timeout=PING_TIMEOUT, deadline=None,
+                early_success=True):
+    """Pings the given hosts at the same time. Each host is sent up to count
+    echo requests and given up after timeout seconds. If early_success is True,
+    a host is not pinged any further after its first reply. All checks are
+    aborted after deadline seconds, if given. Returns a dictionary that maps
+    the hosts to ProbeResult objects.
+
+    """
+    start_time = time.time()
+    results = dict()
+    # file descriptor -> (host, ping process, unprocessed output)
+    probes = dict()
+    devnull = open(os.devnull, 'w')
+    try:
+        for host in hosts:
+            results[host] = ProbeResult(host)
+            try:
+                process = subprocess.Popen([PING_COMMAND, "-n", "-c", str(count),
+                                            "-w", str(int(math.ceil(timeout))), str(host)],
+                                           stdout=subprocess.PIPE, stderr=devnull)
+            except OSError, e:
+                results[host].error = "unable to run %s (%s)" % (PING_COMMAND, e)
+                continue
+            probes[process.stdout.fileno()] = (host, process, "")
+        end_time = start_time + timeout
+        if deadline is not None:
+            end_time = min(end_time, start_time + deadline)
+        while probes:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            for fd in select.select(probes.keys(), [], [], remaining)[0]:
+                host, process, output = probes[fd]
+                data = os.read(fd, 4096)
+                lines = (output + data).split("\n")
+                probes[fd] = (host, process, lines.pop())
+                for line in lines:
+                    match = re.search(r"time[=<]([\d.]+) ?ms", line)
+                    if match:
+                        if not results[host].rtts:
+                            results[host].latency = time.time() - start_time
+                        results[host].rtts.append(float(match.group(1)))
+                if not data or (early_success and results[host].rtts):
+                    _stop_probe(probes.pop(fd)[1], results[host])
+    finally:
+        for host, process, output in probes.values():
+            _stop_probe(process, results[host])
+        devnull.close()
+    return results
+
+
+def _stop_probe(process, result):
+    """Stops the given ping process, if necessary, and completes the result.
+
+    """
+    if process.poll() is None:
+        process.kill()
+    retval = process.wait()
+    process.stdout.close()
+    result.reachable = len(result.rtts) > 0
+    if not result.reachable and result.error is None:
+        if retval > 0:
+            result.error = "%s exited with %d" % (PING_COMMAND, retval)
+        else:
+            result.error = "timeout"
+
+
 def is_available(host):
     """Ping the supplied host and return if the host replied.
 
     """
-    retval = subprocess.call("ping -c5 %s" % host, shell=True)
-    return retval == 0
+    return probe_hosts([host])[host].reachable
+
+
+class InterfaceStateCache:
+    """Cache of the state of the network interfaces, as read from the sysfs
+    directory root. The states are read again if they are older than ttl
+    seconds, if an unknown interface is queried, or after invalidate() has
+    been called, e.g. when an interface has been brought up or down.
+
+    """
+
+    def __init__(self, root=SYSFS_NET, ttl=INTERFACE_STATE_TTL):
+        self.root = root
+        self.ttl = ttl
+        self.last_check = None
+        # if_name -> (interface flags, operational state)
+        self.states = dict()
+
+
+    def reload(self):
+        """Reads the states of all interfaces.
+
+        """
+        self.last_check = time.time()
+        states = dict()
+        try:
+            if_names = os.listdir(self.root)
+        except OSError:
+            # no sysfs, no interfaces
+            if_names = list()
+        for if_name in if_names:
+            flags = self._read(if_name, "flags")
+            if flags is None:
+                continue
+            try:
+                flags = int(flags, 16)
+            except ValueError:
+                continue
+            states[if_name] = (flags, self._read(if_name, "operstate"))
+        self.states = states
+
+
+    def invalidate(self):
+        """Forces the states to be read again on the next query.
+
+        """
+        self.last_check = None
+
+
+    def get_interfaces(self):
+        """Returns the list of names of all network interfaces.
+
+        """
+        self._check()
+        return self.states.keys()
+
+
+    def get_flags(self, if_name):
+        """Returns the interface flags (IFF_*) of the given interface, or None
+        if the interface does not exist.
+
+        """
+        return self._get_state(if_name)[0]
+
+
+    def get_operstate(self, if_name):
+        """Returns the operational state of the given interface as reported by
+        the kernel, e.g. "up", "down" or "dormant", or None if the interface
+        does not exist.
+
+        """
+        return self._get_state(if_name)[1]
+
+
+    def is_up(self, if_name):
+        """Returns if the given interface has been brought up, or None if the
+        interface does not exist.
+
+        """
+        flags = self.get_flags(if_name)
+        if flags is None:
+            return None
+        return flags & IFF_UP != 0
+
+
+    def _get_state(self, if_name):
+        """Returns the cached flags and operational state of the interface.
+
+        """
+        if not self._check() and if_name not in self.states:
+            # the interface may have been added since the last check
+            self.reload()
+        return self.states.get(if_name, (None, None))
+
+
+    def _check(self):
+        """Reads the states again if they may have changed. Returns if the
+        states have been read.
+
+        """
+        if self.last_check is None or time.time() - self.last_check > self.ttl:
+            self.reload()
+            return True
+        return False
+
+
+    def _read(self, if_name, attribute):
+        """Returns the content of the sysfs attribute of the interface, or None
+        if it cannot be read.
+
+        """
+        try:
+            file = open(os.path.join(self.root, if_name, attribute), 'r')
+            try:
+                return file.read().strip()
+            finally:
+                file.close()
+        except (IOError, OSError):
+            return None
+
+
+# Global variable to store the InterfaceStateCache object
+_interface_states = None
+
+
+def get_interface_states():
+    """Returns the cache of the interface states, which reads SYSFS_NET.
+
+    """
+    global _interface_states
+    if _interface_states is None:
+        _interface_states = InterfaceStateCache()
+    return _interface_states
+
+
+def set_interface_states(interface_states):
+    """Sets the cache of the interface states used by is_interface_up(..),
+    e.g. InterfaceStateCache(root) for a fake sysfs tree.
+
+    """
+    global _interface_states
+    _interface_states = interface_states
 
 
 def is_interface_up(if_name):
     """Return if the supplied network interface is set up already.
 
     """
+    up = get_interface_states().is_up(if_name)
     # is the interface name valid?
-    if if_name not in netifaces.interfaces():
+    if up is None:
         raise CHANError("Unable to check if interface is up (invalid interface name %s)" % if_name)
-    # see if the interface name is listed in ifconfig
-    return subprocess.call("ifconfig | grep -q %s" % if_name, shell=True) == 0
+    return up
+
+
+class ChannelIndex:
+    """Index of the channels the wireless interfaces are tuned to. The index is
+    updated by set_channel(..), set_up_interface(..) and shut_down_interface(..),
+    so lookups do not have to query the radios. It is rebuilt from the radios
+    every check_interval seconds, or after invalidate() has been called, to
+    pick up changes made by other programs.
+
+    """
+
+    def __init__(self, check_interval=CHANNEL_INDEX_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.last_check = None
+        # if_name -> channel the interface is tuned to
+        self.channels = dict()
+        # names of the interfaces that are set up
+        self.up = set()
+        self.lock = threading.Lock()
+
+
+    def reload(self):
+        """Rebuilds the index from the channels and states of the radios.
+
+        """
+        backend = get_interface_backend()
+        channels = dict()
+        up = set()
+        for if_name in backend.interface_names():
+            tuned_channel = _get_setting(backend, if_name, "channel")
+            if tuned_channel is None:
+                continue
+            channels[if_name] = tuned_channel
+            if _is_up(backend, if_name):
+                up.add(if_name)
+        self.lock.acquire()
+        try:
+            self.channels = channels
+            self.up = up
+            self.last_check = time.time()
+        finally:
+            self.lock.release()
+
+
+    def invalidate(self):
+        """Forces the index to be rebuilt on the next lookup.
+
+        """
+        self.last_check = None
+
+
+    def get_if_name(self, channel):
+        """Returns the name of the interface that is tuned to the given channel
+        and set up, or None if there is none.
+
+        """
+        if self.last_check is None or time.time() - self.last_check > self.check_interval:
+            self.reload()
+        for if_name, tuned_channel in self.channels.items():
+            if tuned_channel == channel and if_name in self.up:
+                return if_name
+        return None
+
+
+    def set_channel(self, if_name, channel):
+        """Records that the interface has been tuned to the given channel.
+
+        """
+        self.lock.acquire()
+        try:
+            self.channels[if_name] = channel
+        finally:
+            self.lock.release()
+
+
+    def set_up(self, if_name, up):
+        """Records that the interface has been set up or shut down.
+
+        """
+        self.lock.acquire()
+        try:
+            if up:
+                self.up.add(if_name)
+            else:
+                self.up.discard(if_name)
+        finally:
+            self.lock.release()
+
+
+# Global variable to store the ChannelIndex object
+_channel_index = None
+
+
+def get_channel_index():
+    """Returns the index of the channels of the wireless interfaces.
+
+    """
+    global _channel_index
+    if _channel_index is None:
+        _channel_index = ChannelIndex()
+    return _channel_index
 
 
 def get_if_name(channel):
     """Returns the name of the interface that is tuned to the given channel.
 
     """
-    for if_name in iwlibs.getWNICnames():
-        try:
-            tuned_channel = iwlibs.Wireless(if_name).getChannel()
-        except IOError:
-            continue
-        if tuned_channel == channel and is_interface_up(if_name):
-            return if_name
-    raise CHANError("No interface tuned to channel %s and set up" % channel)
+    if_name = get_channel_index().get_if_name(channel)
+    if if_name is None:
+        raise CHANError("No interface tuned to channel %s and set up" % channel)
+    return if_name
 
 
 def get_free_if_name(if_names=None):
@@ -114,10 +612,11 @@ def get_free_if_name(if_names=None):
     """
     # if no interfaces are specified, use all wireless interfaces
     if not if_names:
-        if_names = iwlibs.getWNICnames()
+        if_names = get_interface_backend().interface_names()
+    backend = get_interface_backend()
     for if_name in if_names:
         print if_name
-        if not is_interface_up(if_name):
+        if not _is_up(backend, if_name):
             return if_name
     raise CHANError("No free interfaces left")
 
@@ -142,98 +641,632 @@ def cell_id(iface):
         'wlan2': '8A:BF:D2:99:8B:45'
         }.get(iface, 'aa:aa:aa:aa:aa:aa')
 
-def set_up_interface(if_name):
-    """Sets  up an interface with ifconfig / iwconfig commands. This way, we are
-    independent of the settings in /etc/network/interfaces, which may change over time.
+class Span:
+    """Timing of a stage of the interface configuration, e.g. a channel switch.
+    Spans are created by trace(..) and passed to the trace sinks when the stage
+    has finished. parent is the span of the enclosing stage, if any.
 
     """
-    chan = channel(if_name)
-    essid = cell_id(if_name)
 
-    # put iface down (just in case)
-    subprocess.call("ifconfig " + if_name + " down", shell=True)
-    subprocess.call("ifdown " + if_name, shell=True)
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self.start = None
+        # duration (in seconds) of the stage
+        self.duration = None
+        # exception raised by the stage, if any
+        self.error = None
+
 
-    subprocess.call("iwconfig " + if_name + " mode ad-hoc", shell=True)
-    subprocess.call("iwconfig " + if_name + " essid des-mesh" + str(chan), shell=True)
-    subprocess.call("iwconfig " + if_name + " channel " + str(chan), shell=True)
-    subprocess.call("iwconfig " + if_name + " ap " + essid, shell=True)
-    subprocess.call("iwconfig " + if_name + " txpower auto", shell=True)
-    subprocess.call("iwconfig " + if_name + " rate 6M", shell=True)
-    subprocess.call("ifconfig " + if_name + " $(calc_ip " + if_name[-1] + ") netmask 255.255.0.0", shell=True)
-    # double check it the interface is up now
-    #if retval != 0 or not is_interface_up(if_name):
-    #    raise CHANError("Unable to set up interface %s" % if_name)
+    def __enter__(self):
+        stack = _get_span_stack()
+        if stack:
+            self.parent = stack[-1]
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.duration = time.time() - self.start
+        self.error = value
+        _get_span_stack().pop()
+        for sink in list(_trace_sinks):
+            # a failing sink must not hide the result of the traced stage
+            try:
+                sink(self)
+            except Exception, e:
+                print "des_chan.util: Trace sink failed: %s" % e
+        return False
+
+
+    def get_path(self):
+        """Returns the names of the enclosing stages and this stage, separated
+        by slashes.
+
+        """
+        if self.parent is None:
+            return self.name
+        return self.parent.get_path() + "/" + self.name
+
+
+    def __str__(self):
+        attributes = " ".join(["%s=%s" % item for item in sorted(self.attributes.items())])
+        text = "%s %.6fs %s" % (self.get_path(), self.duration, attributes)
+        if self.error is not None:
+            text += " error=%s" % self.error
+        return text.strip()
+
+
+class _NullSpan:
+    """Span used while tracing is disabled, it does not record anything.
+
+    """
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+_null_span = _NullSpan()
+# sinks that receive the finished spans
+_trace_sinks = list()
+# stack of the open spans of each thread
+_span_stacks = threading.local()
+
+
+class RingBufferSink:
+    """Trace sink that keeps the last size spans in memory.
+
+    """
+
+    def __init__(self, size=1000):
+        self.spans = deque(maxlen=size)
+
+
+    def __call__(self, span):
+        self.spans.append(span)
+
+
+    def clear(self):
+        self.spans.clear()
+
+
+class LogSink:
+    """Trace sink that writes a line per span to the given file.
+
+    """
+
+    def __init__(self, file=sys.stderr):
+        self.file = file
+
+
+    def __call__(self, span):
+        self.file.write("trace: %s\n" % span)
+
+
+def add_trace_sink(sink):
+    """Enables tracing and adds the given sink, a RingBufferSink, a LogSink or
+    any callable that takes a Span.
+
+    """
+    _trace_sinks.append(sink)
+
+
+def remove_trace_sink(sink):
+    """Removes the given sink, tracing is disabled if no sinks are left.
+
+    """
+    _trace_sinks.remove(sink)
+
+
+def trace(name, **attributes):
+    """Returns a context manager that times the enclosed stage. If no trace
+    sink has been added, nothing is recorded.
+
+        with trace("essid", if_name=if_name):
+            ...
+
+    """
+    if not _trace_sinks:
+        return _null_span
+    return Span(name, attributes)
+
+
+def _get_span_stack():
+    """Returns the stack of open spans of the current thread.
+
+    """
+    try:
+        return _span_stacks.stack
+    except AttributeError:
+        _span_stacks.stack = list()
+        return _span_stacks.stack
+
+
+# ioctl request codes (linux/sockios.h, linux/wireless.h)
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891B
+SIOCSIFFLAGS = 0x8914
+SIOCSIFADDR = 0x8916
+SIOCSIFNETMASK = 0x891C
+SIOCSIWRATE = 0x8B20
+SIOCSIWTXPOW = 0x8B26
+IFF_UP = 0x1
+
+
+class InterfaceConfig:
+    """Desired settings of a wireless interface. Settings that are None are
+    left unchanged. txpower is given in dBm or as "auto", rate in bit/s, as
+    string like "6M", or as "auto". If up is True or False, the interface is
+    brought up or down.
+
+    """
+
+    # order in which the settings are applied
+    SETTINGS = ("mode", "essid", "channel", "cell_id", "txpower", "rate", "ip")
+
+    def __init__(self, if_name, mode=None, essid=None, channel=None,
+                 cell_id=None, txpower=None, rate=None, ip=None,
+                 netmask=None, up=None):
+        self.if_name = if_name
+        self.mode = mode
+        self.essid = essid
+        self.channel = channel
+        self.cell_id = cell_id
+        self.txpower = txpower
+        self.rate = rate
+        self.ip = ip
+        self.netmask = netmask
+        self.up = up
+
+
+    def get_settings(self):
+        """Returns a list of (name, value) tuples of the settings that are to
+        be changed, in the order they have to be applied.
+
+        """
+        settings = list()
+        for name in self.SETTINGS:
+            value = getattr(self, name)
+            if value is not None:
+                if name == "ip":
+                    value = (value, self.netmask)
+                settings.append((name, value))
+        return settings
+
+
+class IoctlInterfaceBackend:
+    """Configures interfaces in-process by pythonwifi and ioctl calls, i.e.,
+    without starting ifconfig or iwconfig processes.
+
+    """
+
+    def __init__(self):
+        # socket for the ioctl calls
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+    def interface_names(self):
+        """Returns the names of the wireless interfaces.
+
+        """
+        return iwlibs.getWNICnames()
+
+
+    def get(self, if_name, name):
+        """Returns the current value of the given setting, or None if it cannot
+        be read.
+
+        """
+        interface = iwlibs.Wireless(if_name)
+        if name == "mode":
+            return interface.getMode()
+        if name == "essid":
+            return interface.getEssid()
+        if name == "channel":
+            return interface.getChannel()
+        if name == "cell_id":
+            return interface.getAPaddr()
+        if name == "up":
+            return bool(self._get_flags(if_name) & IFF_UP)
+        if name == "ip":
+            return self._get_address(if_name, SIOCGIFADDR)
+        if name == "netmask":
+            return self._get_address(if_name, SIOCGIFNETMASK)
+        return None
+
+
+    def set(self, if_name, name, value):
+        """Changes the given setting of the interface.
+
+        """
+        interface = iwlibs.Wireless(if_name)
+        if name == "mode":
+            interface.setMode(value)
+        elif name == "essid":
+            interface.setEssid(value)
+        elif name == "channel":
+            interface.setChannel(value)
+        elif name == "cell_id":
+            interface.setAPaddr(value)
+        elif name == "txpower":
+            if value == "auto":
+                self._set_iw_param(if_name, SIOCSIWTXPOW, -1, 0)
+            else:
+                self._set_iw_param(if_name, SIOCSIWTXPOW, int(value), 1)
+        elif name == "rate":
+            if value == "auto":
+                self._set_iw_param(if_name, SIOCSIWRATE, -1, 0)
+            else:
+                self._set_iw_param(if_name, SIOCSIWRATE, _parse_rate(value), 1)
+        elif name == "ip":
+            ip, netmask = value
+            self._set_address(if_name, SIOCSIFADDR, ip)
+            if netmask is not None:
+                self._set_address(if_name, SIOCSIFNETMASK, netmask)
+        elif name == "up":
+            flags = self._get_flags(if_name)
+            if value:
+                flags |= IFF_UP
+            else:
+                flags &= ~IFF_UP
+            fcntl.ioctl(self.sock, SIOCSIFFLAGS, struct.pack("16sH22x", if_name, flags))
+        else:
+            raise ValueError("unknown setting %s" % name)
+
+
+    def _get_flags(self, if_name):
+        result = fcntl.ioctl(self.sock, SIOCGIFFLAGS, struct.pack("16sH22x", if_name, 0))
+        return struct.unpack("16sH22x", result)[1]
+
+
+    def _get_address(self, if_name, request):
+        ifreq = struct.pack("16sHH4s16x", if_name, socket.AF_INET, 0, "\0" * 4)
+        result = fcntl.ioctl(self.sock, request, ifreq)
+        return socket.inet_ntoa(struct.unpack("16sHH4s16x", result)[3])
+
+
+    def _set_address(self, if_name, request, address):
+        # struct ifreq with struct sockaddr_in
+        ifreq = struct.pack("16sHH4s16x", if_name, socket.AF_INET, 0,
+                            socket.inet_aton(address))
+        fcntl.ioctl(self.sock, request, ifreq)
+
+
+    def _set_iw_param(self, if_name, request, value, fixed):
+        # struct iwreq with struct iw_param (value, fixed, disabled, flags)
+        iwreq = struct.pack("16siBBH8x", if_name, value, fixed, 0, 0)
+        fcntl.ioctl(self.sock, request, iwreq)
+
+
+class RecordingInterfaceBackend:
+    """Backend without radios that records all operations and keeps the
+    resulting settings in memory. The time an operation takes on real hardware
+    can be emulated by delays, a dictionary that maps setting names to
+    seconds. Each recorded operation is a tuple of interface name, setting
+    name, value, and duration. The wireless interfaces are the given if_names,
+    or the interfaces in state.
+
+    """
+
+    def __init__(self, state=None, delays=None, if_names=None):
+        # if_name -> setting name -> value
+        self.state = state or dict()
+        self.delays = delays or dict()
+        self.if_names = if_names
+        self.operations = list()
+
+
+    def interface_names(self):
+        if self.if_names is not None:
+            return list(self.if_names)
+        return sorted(self.state.keys())
+
+
+    def get(self, if_name, name):
+        return self.state.get(if_name, {}).get(name)
+
+
+    def set(self, if_name, name, value):
+        start_time = time.time()
+        if name in self.delays:
+            time.sleep(self.delays[name])
+        settings = self.state.setdefault(if_name, dict())
+        if name == "ip":
+            # kept like they are read from an interface
+            settings["ip"], netmask = value
+            if netmask is not None:
+                settings["netmask"] = netmask
+        else:
+            settings[name] = value
+        self.operations.append((if_name, name, value, time.time() - start_time))
+
+
+# Global variable to store the interface backend, the IoctlInterfaceBackend is
+# used if no other backend has been set
+_interface_backend = None
+
+
+def get_interface_backend():
+    """Returns the backend used to configure interfaces.
+
+    """
+    global _interface_backend
+    if _interface_backend is None:
+        _interface_backend = IoctlInterfaceBackend()
+    return _interface_backend
+
+
+def set_interface_backend(backend):
+    """Sets the backend used to configure interfaces, e.g. a
+    RecordingInterfaceBackend for tests and measurements without radios.
+
+    """
+    global _interface_backend
+    _interface_backend = backend
+
+
+def apply_interface_config(config, backend=None):
+    """Applies the given InterfaceConfig. Settings that already have the desired
+    value are skipped. If the mode is changed, the interface is brought down
+    before. Returns the list of names of the changed settings.
+
+    """
+    if backend is None:
+        backend = get_interface_backend()
+    if_name = config.if_name
+    operations = list()
+    for name, value in config.get_settings():
+        if name in ("ip", "txpower", "rate") or _get_setting(backend, if_name, name) != value:
+            operations.append((name, value))
+    if config.up is False or (config.mode is not None and ("mode", config.mode) in operations):
+        if _get_setting(backend, if_name, "up") is not False:
+            operations.insert(0, ("up", False))
+    if config.up is True:
+        operations.append(("up", True))
+    try:
+        for name, value in operations:
+            try:
+                with trace(name, if_name=if_name, value=value):
+                    backend.set(if_name, name, value)
+            except (ValueError, IOError), e:
+                raise CHANError("Unable to set %s of interface %s to %s (%s)" % (name, if_name, value, e))
+    finally:
+        if ("up", True) in operations or ("up", False) in operations:
+            get_interface_states().invalidate()
+    return [name for name, value in operations]
+
+
+def _apply_and_index(config):
+    """Applies the given InterfaceConfig and updates the channel index.
+
+    """
+    index = get_channel_index()
+    try:
+        apply_interface_config(config)
+    except CHANError:
+        # the interface may have been changed partially
+        index.invalidate()
+        raise
+    if config.channel is not None:
+        index.set_channel(config.if_name, config.channel)
+    if config.up is not None:
+        index.set_up(config.if_name, config.up)
+
+
+def _is_up(backend, if_name):
+    """Returns if the interface is up according to the backend, or to the
+    interface states if the backend does not know.
+
+    """
+    up = _get_setting(backend, if_name, "up")
+    if up is not None:
+        return up
+    try:
+        return is_interface_up(if_name)
+    except CHANError:
+        return False
+
+
+def _get_setting(backend, if_name, name):
+    """Returns the current value of the setting, or None if it is unknown.
+
+    """
+    try:
+        return backend.get(if_name, name)
+    except (ValueError, IOError):
+        return None
+
+
+def _get_config(backend, if_name):
+    """Returns an InterfaceConfig with the current ESSID, channel, cell ID, and
+    IP address of the interface. Settings that cannot be read are None.
+
+    """
+    config = InterfaceConfig(if_name)
+    for name in ("essid", "channel", "cell_id", "ip", "netmask"):
+        setattr(config, name, _get_setting(backend, if_name, name))
+    return config
+
+
+def _parse_rate(rate):
+    """Converts a bit rate like "6M" or "5.5M" to bit/s.
+
+    """
+    if isinstance(rate, (int, long)):
+        return rate
+    factors = {"k": 1e3, "M": 1e6, "G": 1e9}
+    if rate[-1] in factors:
+        return int(float(rate[:-1]) * factors[rate[-1]])
+    return int(rate)
+
+
+def _calc_ip(if_name):
+    """Returns the IP address of the given interface as computed by the calc_ip
+    script of the testbed.
+
+    """
+    return subprocess.Popen(["calc_ip", if_name[-1]],
+                            stdout=subprocess.PIPE).communicate()[0].strip()
+
+
+def set_up_interface(if_name):
+    """Sets up an interface with the default settings for its name. This way, we
+    are independent of the settings in /etc/network/interfaces, which may change
+    over time.
+
+    """
+    chan = channel(if_name)
+    config = InterfaceConfig(if_name, mode="Ad-Hoc", essid="des-mesh" + str(chan),
+                             channel=chan, cell_id=cell_id(if_name), txpower="auto",
+                             rate="6M", ip=_calc_ip(if_name), netmask="255.255.0.0",
+                             up=True)
+    _apply_and_index(config)
 
 
 def shut_down_interface(if_name):
     """Shuts down the given interface.
 
     """
-    subprocess.call("ifdown %s" % if_name, shell=True)
-    subprocess.call("ifconfig %s down" % if_name, shell=True)
-    if is_interface_up(if_name):
+    _apply_and_index(InterfaceConfig(if_name, up=False))
+    if _is_up(get_interface_backend(), if_name):
         raise CHANError("Unable to shut down interface %s" % if_name)
 
 
 def shut_down_interfaces(if_names=None):
-    """Wrapper to shut down more than one interface.
+    """Wrapper to shut down more than one interface. The interfaces are shut
+    down at the same time.
 
     """
     # if no interfaces are specified, use all wireless interfaces
     if not if_names:
-        if_names = iwlibs.getWNICnames()
-    for if_name in if_names:
-        shut_down_interface(if_name)
+        if_names = get_interface_backend().interface_names()
+    results = _run_parallel([(if_name, shut_down_interface, (if_name,))
+                             for if_name in if_names])
+    errors = ["%s: %s" % (if_name, e) for if_name, (duration, e)
+              in sorted(results.items()) if e is not None]
+    if errors:
+        raise CHANError("Unable to shut down interfaces (%s)" % ", ".join(errors))
 
 
 def get_channel(if_name):
     """Returns the channel the given interface is currently operating on. 
 
     """
-    if if_name not in iwlibs.getWNICnames():
-        raise CHANError("Unable to set channel (invalid wireless interface: %s)" % if_name)
-    interface = iwlibs.Wireless(if_name)
-    return interface.getChannel()
+    backend = get_interface_backend()
+    if if_name not in backend.interface_names():
+        raise CHANError("Unable to get channel (invalid wireless interface: %s)" % if_name)
+    return _get_setting(backend, if_name, "channel")
 
 def set_channel(if_name, channel, set_ip=True):
     """Set the channel for the interface. This is a bit more complicated since we also have
     to set the ESSID, Cell ID,  and the IP according to /etc/hosts.
 
     """
-    if if_name not in iwlibs.getWNICnames():
-        raise CHANError("Unable to set channel (invalid wireless interface: %s)" % if_name)
-    interface = iwlibs.Wireless(if_name)
-    try:
+    with trace("set_channel", if_name=if_name, channel=channel):
+        backend = get_interface_backend()
+        if if_name not in backend.interface_names():
+            raise CHANError("Unable to set channel (invalid wireless interface: %s)" % if_name)
         print if_name, channel
-        interface.setChannel(channel)
-    except ValueError, IOError:
-        raise CHANError("Unable to set channel (invalid channel: %s)" % channel)
-    print "channel: %s" % interface.getChannel()
-    # essid
-    essid = "des-mesh-ch%d" % channel
-    interface.setEssid(essid)
-    print "essid: %s" % interface.getEssid()
-    if interface.getEssid() != essid:
-        raise CHANError("Unable to set channel (ESSID %s cannot be set)" % essid)
-    # ip address
-    if set_ip:
-        host_name = "%s-ch%d" % (resolve_node_name("localhost"), channel)
-        print host_name
-        ip = socket.gethostbyname(host_name)
-        print "ip: %s" % ip
-        retval = subprocess.call("ifconfig %s %s netmask 255.255.255.128" %
-                                 (if_name, ip), shell=True)
-        if retval != 0:
-            raise CHANError("Unable to set channel (IP %s cannot be assigned)"
-                             % ip)
-    ap_addr = "02:00:00:00:00:%02X" % channel
-    interface.setAPaddr(ap_addr)
-    actual_ap_addr = interface.getAPaddr()
-    print "ap: %s" % actual_ap_addr
-    # double check
-    # if not (actual_ap_addr == ap_addr or actual_ap_addr == "00:00:00:00:00:00"):
-    #    raise CHANError("Unable to set channel (AP address should be %s, but is %s)" % (ap_addr, actual_ap_addr))
+        config = InterfaceConfig(if_name, channel=channel,
+                                 essid="des-mesh-ch%d" % channel,
+                                 cell_id="02:00:00:00:00:%02X" % channel)
+        # ip address
+        if set_ip:
+            with trace("ip_lookup"):
+                config.ip = get_node_ip(resolve_node_name("localhost"), channel)
+            config.netmask = "255.255.255.128"
+            print "ip: %s" % config.ip
+        with trace("apply"):
+            _apply_and_index(config)
+        # double check
+        with trace("verify"):
+            essid = _get_setting(backend, if_name, "essid")
+        print "essid: %s" % essid
+        if essid != config.essid:
+            raise CHANError("Unable to set channel (ESSID %s cannot be set)" % config.essid)
+
+
+class ChannelSwitchResult:
+    """Result of the channel switch of a single interface.
+
+    """
+
+    def __init__(self, if_name, channel, previous_config):
+        self.if_name = if_name
+        self.channel = channel
+        # InterfaceConfig with the settings before the switch
+        self.previous_config = previous_config
+        self.previous_channel = previous_config.channel
+        self.success = False
+        # exception raised by the switch
+        self.error = None
+        # duration of the switch (in seconds)
+        self.duration = None
+        # the interface has been restored to the previous settings
+        self.rolled_back = False
+        self.rollback_error = None
+
+
+def set_channels(plan, set_ip=True, rollback=True):
+    """Switches several interfaces to new channels at the same time. plan maps
+    interface names to channels. Returns a dictionary that maps the interface
+    names to ChannelSwitchResult objects. If rollback is True and a switch
+    fails, all interfaces, including the failed ones, which may have been
+    changed partially, are restored to their previous settings.
+
+    """
+    backend = get_interface_backend()
+    results = dict()
+    for if_name, channel in plan.items():
+        results[if_name] = ChannelSwitchResult(if_name, channel,
+                                               _get_config(backend, if_name))
+    switched = _run_parallel([(if_name, set_channel, (if_name, channel, set_ip))
+                              for if_name, channel in plan.items()])
+    for if_name, (duration, e) in switched.items():
+        results[if_name].duration = duration
+        results[if_name].error = e
+        results[if_name].success = e is None
+    failed = [result for result in results.values() if not result.success]
+    if failed and rollback:
+        restore = [result for result in results.values()
+                   if result.previous_config.get_settings()]
+        restored = _run_parallel([(result.if_name, _apply_and_index,
+                                   (result.previous_config,))
+                                  for result in restore])
+        for if_name, (duration, e) in restored.items():
+            results[if_name].rolled_back = e is None
+            results[if_name].rollback_error = e
+    return results
+
+
+def _run_parallel(calls):
+    """Runs the given calls in separate threads. calls is a list of (key,
+    function, arguments) tuples. Returns a dictionary that maps the keys to
+    tuples of the duration of the call and the raised exception (or None).
+
+    """
+    results = dict()
+    def run(key, function, args):
+        start_time = time.time()
+        try:
+            function(*args)
+        except Exception, e:
+            results[key] = (time.time() - start_time, e)
+        else:
+            results[key] = (time.time() - start_time, None)
+    threads = [threading.Thread(target=run, args=call) for call in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
 
 
 def red(str):